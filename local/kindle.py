@@ -12,13 +12,25 @@ import re
 import unicodedata
 import os
 import os.path
-import configparser
 import time
 import tempfile
 import argparse
 import sys
 import shutil
+import shlex
 import subprocess
+import tarfile
+import io
+import json
+import threading
+import queue
+import concurrent.futures
+
+# the FILELIST storage and the converters are shared with the shell account script
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'on_shell_account'))
+import compression
+import converters
+import filelist
 
 __version__ = '1.1'
 __author__ = 'Michał Słomkowski'
@@ -30,13 +42,18 @@ remotePath = '#### INSERT URL TO YOUR LIBRARY ON SHELL ACCOUNT ####'
 metadataFileName = "FILELIST"
 
 # Configuration of the converter to .mobi format. Present setting is for ebook-convert from Calibre.
+# The options are the same as in [mobi_converter] section of extract.ini.
 mobiConverter = {
+		# 'command' runs the command for each file, 'worker' keeps Calibre loaded in the worker processes
+		'backend' : 'command',
 		'command' : 'ebook-convert @@OLD_NAME@@ @@NEW_NAME@@',
+		# 'worker_command' : 'calibre-debug -e @@WORKER@@',
 		# TODO check values_success
 		'values_success' : (0, 1),
 		# Kindlegen needs only filename, without full path as the output file. Use basename in this case.
-		'output_file' : lambda filePath: filePath
+		'output_file' : lambda filePath: filePath,
 		# 'output_file' : lambda filePath: os.path.basename(filePath)
+		'quiet' : True
 		}
 
 # formats which will be added to the library. Other files are omitted. The boolean value indicates the need to convert it to .mobi format.
@@ -54,6 +71,16 @@ supportedFormats = {
 		'azw2' : False,
 		'pdf' : False
 		}
+
+# Compressed variants ('<file>.gz') are uploaded next to the books if they're smaller by this part of the original size.
+# Kindle downloads them instead of the plain files. None disables them.
+compressionMinSaving = 0.1
+
+# Command which runs on_shell_account/receive.py on the shell account, e.g. 'python3 mailbook/on_shell_account/receive.py'.
+# If it's set, the books are streamed to it through one SSH connection and it updates FILELIST on the server under the lock
+# shared with extract.py. Otherwise FILELIST is downloaded, updated locally and sent back with scp.
+remoteHelper = None
+
 # for debug & development
 disableSendingChanges = False
 
@@ -74,6 +101,8 @@ def convertToFileName(original):
 def getValidFileList(fileList, printInvalidFileError = True):
 	"""Takes some file list. Checks if these files exists and have appropriate extension."""
 	validFileList = []  # (performConvert, originalFilename, newFilename)
+	# the output files are written to one directory and FILELIST keeps the names in lowercase
+	newNames = {}
 	for f in fileList:
 		if not os.path.isfile(f):
 			print("Error! File " + f + " doesn't exist.")
@@ -87,82 +116,188 @@ def getValidFileList(fileList, printInvalidFileError = True):
 					performConvert = True
 				else:
 					performConvert = False
-				validFileList.append((performConvert, os.path.abspath(f), newFileName))
+				if newFileName.lower() in newNames:
+					print("Warning! Files " + newNames[newFileName.lower()] + " and " + f + " give the same file " + newFileName + ". Omitting " + f + ".")
+				else:
+					newNames[newFileName.lower()] = f
+					validFileList.append((performConvert, os.path.abspath(f), newFileName))
 				break
 		if printInvalidFileError and not found:
 			print("Warning! File " + f + " has not valid extension. Omitting.")
 	return validFileList
 
 
-def convertFiles(fileList, outputDir):
-	"""Takes the list of files and converts them to .mobi format."""
+def convertFiles(fileList, outputDir, jobs = 1, ready = None):
+	"""Takes the list of files and converts them to .mobi format. Up to 'jobs' conversions run at the same time,
+	the files which don't need the conversion are copied in the meantime. ready(newName) is called for each file
+	as soon as it's in outputDir. Returns the list of the new file names in the order of fileList.
+	"""
 	outputDir = os.path.abspath(outputDir) + "/"
-	updateList = []
-	for (conversion, name, newName) in fileList:
-		if not conversion:
-			print('* ' + name)
-			shutil.copy(name, os.path.join(outputDir, newName))
-			updateList.append(newName)
-		else:
-			print('* ' + os.path.basename(name) + " > " + newName + "  || Conversion ...")  # no newline
-			sys.stdout.flush()
-
-			command = re.sub(r'@@OLD_NAME@@', name, mobiConverter['command'])
-			command = re.sub(r'@@NEW_NAME@@', mobiConverter['output_file'](os.path.join(outputDir, newName)), command)
-
-			with open("/dev/null", "w") as devNull:
-				ret = subprocess.call(command.split(), stdout = devNull, stderr = devNull)
-
-			if ret in mobiConverter['values_success']:
-				print("  OK.")
-				updateList.append(newName)
-			else:
-				print("  failed.")
+	done = [False] * len(fileList)
+	converter = converters.create(dict(mobiConverter, jobs = jobs))
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers = max(1, jobs)) as pool:
+		conversions = {}
+		for index, (conversion, name, newName) in enumerate(fileList):
+			if conversion:
+				conversions[pool.submit(converter.convert, name, os.path.join(outputDir, newName))] = index
+
+		for index, (conversion, name, newName) in enumerate(fileList):
+			if not conversion:
+				print('* ' + name)
+				shutil.copy(name, os.path.join(outputDir, newName))
+				done[index] = True
+				if ready:
+					ready(newName)
+
+		# results are printed in order of completion, one line for each file
+		for future in concurrent.futures.as_completed(conversions):
+			index = conversions[future]
+			conversion, name, newName = fileList[index]
+			try:
+				done[index] = future.result()
+			except (OSError, converters.ConversionTimeout) as exp:
+				print("Could not run the converter: " + str(exp))
+			print('* ' + os.path.basename(name) + " > " + newName + "  || Conversion " + ("OK." if done[index] else "failed."))
+			if done[index] and ready:
+				ready(newName)
+
+	converter.close()
+	return [newName for (conversion, name, newName), success in zip(fileList, done) if success]
+
+def writeVariant(path):
+	"""Writes the compressed variant of the file if it's worth it. Returns the number of bytes saved."""
+	if compressionMinSaving is None:
+		return 0
+	return compression.writeVariant(path, compressionMinSaving)
+
+class Uploader:
+	"""Sends the files to the remote directory in the background, while the next files are being converted.
+	The files which became ready during the previous transfer are sent together by one scp.
+	"""
+
+	def __init__(self, remoteDirectory):
+		self.target = remotePath + "/" + remoteDirectory if remoteDirectory else remotePath
+		self.queue = queue.Queue()
+		self.failed = False
+		self.thread = threading.Thread(target = self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def put(self, paths):
+		self.queue.put(paths)
+
+	def run(self):
+		finished = False
+		while not finished:
+			batch = []
+			paths = self.queue.get()
+			while True:
+				if paths is None:
+					finished = True
+					break
+				batch.extend(paths)
+				try:
+					paths = self.queue.get_nowait()
+				except queue.Empty:
+					break
+			if len(batch) > 0 and not self.failed:
+				try:
+					self.send(batch)
+				except OSError:
+					self.failed = True
+
+	def send(self, paths):
+		if subprocess.call(["scp", "-qC"] + sshOptions + paths + [self.target]) != 0:
+			self.failed = True
+
+	def close(self):
+		"""Waits until all files are sent. Returns True if all of them were sent."""
+		self.queue.put(None)
+		self.thread.join()
+		return not self.failed
+
+class HelperUploader(Uploader):
+	"""Streams the files as tar archive to receive.py on the shell account. The first member is the manifest
+	with the collection name and the restart flag, FILELIST is updated by the helper when the archive ends.
+	"""
+
+	def __init__(self, collection, collectionExact, restartFlag):
+		host, path = remotePath.split(':', 1)
+		self.process = subprocess.Popen(["ssh", "-C"] + sshOptions + [host, remoteHelper + " " + shlex.quote(path)], stdin = subprocess.PIPE)
+		self.archive = tarfile.open(fileobj = self.process.stdin, mode = 'w|')
+
+		manifest = json.dumps({'collection' : collection, 'exact' : collectionExact, 'restart' : restartFlag}).encode('utf-8')
+		info = tarfile.TarInfo('MANIFEST.json')
+		info.size = len(manifest)
+		info.mtime = time.time()
+		self.archive.addfile(info, io.BytesIO(manifest))
+		Uploader.__init__(self, None)
+
+	def send(self, paths):
+		for path in paths:
+			self.archive.add(path, arcname = os.path.basename(path))
+		self.process.stdin.flush()
+
+	def close(self):
+		"""Waits until all files are sent and FILELIST is updated. Returns True on success."""
+		sent = Uploader.close(self)
+		# the archive is closed even after the failure, otherwise it tries to write the end of the archive again later
+		for close in (self.archive.close, self.process.stdin.close):
+			try:
+				close()
+			except OSError:
+				sent = False
+		return self.process.wait() == 0 and sent
+
+def makeRemoteDirectory(remoteDirectory):
+	host, path = remotePath.split(':', 1)
+	return subprocess.call(["ssh"] + sshOptions + [host, "mkdir -p " + shlex.quote(os.path.join(path, remoteDirectory))])
+
+def removeRemoteVariants(remoteDirectory, files):
+	"""Removes the variants left from the older versions of the files on the server, so Kindle doesn't download the old content."""
+	host, path = remotePath.split(':', 1)
+	variants = [shlex.quote(compression.variantPath(os.path.join(path, remoteDirectory, file))) for file in files]
+	return subprocess.call(["ssh"] + sshOptions + [host, "rm -f " + " ".join(variants)])
+
+def resolveCollection(metadataFile, collection = None, collectionExact = False):
+	"""Returns the name of the collection matching the given name in the metadata file, the given name for the new collection
+	or NO_COLLECTION if there's no name.
+	"""
+	if not collection:
+		return filelist.NO_COLLECTION
+
+	sections = filelist.load(metadataFile).sections()
+	collection = filelist.matchCollection(sections, collection, collectionExact)
+
+	if collection in sections:
+		print("Using collection name: " + collection)
+	else:
+		print("Creating collection: " + collection)
+	return collection
 
-	return updateList
+def getCollectionDirectory(collection):
+	"""Returns proposed directory name for collection."""
+	if collection == filelist.NO_COLLECTION:
+		return ''
+	else:
+		return convertToFileName(collection)
 
-def updateMetadataFile(metadataFile, filesList, restartFlag, collection = None, collectionExact = False):
+def updateMetadataFile(metadataFile, filesDirectory, filesList, restartFlag, collection):
 	"""Reads metadata file and applies metadata."""
 
-	metadata = configparser.SafeConfigParser()
-	metadata.read(metadataFile)
-
 	timestamp = time.strftime("%Y-%m-%d_%H:%M:%S", time.gmtime())
 
-	if collection:
-		if not collectionExact:
-			matches = [name for name in metadata.sections() if re.match(collection, name, re.I)]
-
-			if len(matches) > 0:
-				collection = min(matches, key = len)
-
-		if collection in metadata.sections():
-			print("Using collection name: " + collection)
-		else:
-			print("Creating collection: " + collection)
-
-	else:
-		collection = "___NO_COLLECTION___"
-
-	if not metadata.has_section(collection):
-		metadata.add_section(collection)
-
-	if restartFlag:
-		print("Applying restart flag.")
-		metadata['___SPECIAL___'] = {}
-		metadata['___SPECIAL___']['RestartTimeStamp'] = timestamp;
+	contents = [filelist.describeFile(os.path.join(filesDirectory, file)) for file in filesList]
 
-	for file in filesList:
-		metadata.set(collection, file, timestamp)
+	# the full files are sent to the server, so they have to contain all changes
+	with filelist.transaction(metadataFile, forceCompaction = True) as metadata:
+		if restartFlag:
+			print("Applying restart flag.")
+			metadata.setRestart(timestamp)
 
-	with open(metadataFile, 'w') as configfile:
-	    metadata.write(configfile)
-
-	# return proposed directory name for collection
-	if collection == "___NO_COLLECTION___":
-		return ''
-	else:
-		return convertToFileName(collection)
+		for file, content in zip(filesList, contents):
+			metadata.set(collection, file, timestamp, content)
 
 # get command line options
 
@@ -175,6 +310,7 @@ parser = argparse.ArgumentParser(description = description)
 
 parser.add_argument("-d", "--delete", action = 'store_true', help = "delete original files")
 parser.add_argument("-r", "--restart", action = 'store_true', help = "restart Kindle after update. Needed to apply generated collections")
+parser.add_argument("-j", "--jobs", type = int, default = os.cpu_count() or 1, help = "number of conversions at the same time, the number of CPUs by default")
 
 group = parser.add_mutually_exclusive_group()
 group.add_argument("-c", "--collection", nargs = 1, help = """collection name. You can specify partial name which matches existing collection.
@@ -199,51 +335,114 @@ if len(fileList) == 0:
 
 tempDir = tempfile.mkdtemp('kindle')
 
-# check if it's possible to download the .ini file with metadata
-print("Trying to download actual file list...")
-ret = subprocess.call(["scp", remotePath + "/" + metadataFileName, tempDir])  # , stdout = devNull, stderr = devNull)
-if ret != 0:
-	print("Cannot download " + metadataFileName)
-	exit(1)
-
-filesToUpdate = convertFiles(fileList, outputDir = tempDir)
-
-up = lambda coll, exact: updateMetadataFile(os.path.join(tempDir, metadataFileName), filesToUpdate, args.restart, coll, exact)
-if args.collection_exact:
-	collectionDirectory = up(args.collection_exact[0], True)
-elif args.collection:
-	collectionDirectory = up(args.collection[0], False)
-else:
-	collectionDirectory = up(None, False)
-
-# if collection is specified, copy all files to new folder within tempDir. It's needed to copy it via SSH later.
-if collectionDirectory:
-	collDir = os.path.join(tempDir, collectionDirectory)
-	os.mkdir(collDir)
-	for file in map(lambda f: os.path.join(tempDir, f), filesToUpdate):
-		shutil.move(file, collDir)
-	updateList = [collDir]
-else:
-	updateList = [ os.path.join(tempDir, f) for f in filesToUpdate ]
+# all SSH connections share the first one, they close after few idle seconds
+sshOptions = ["-o", "ControlMaster=auto", "-o", "ControlPath=" + os.path.join(tempDir, "ssh-control"), "-o", "ControlPersist=10"]
+
+withoutVariant = []
+saved = 0
+
+def sendFile(newName):
+	global saved
+	path = os.path.join(outputDir, newName)
+	fileSaved = writeVariant(path)
+	saved += fileSaved
+	if fileSaved == 0:
+		withoutVariant.append(newName)
+	if uploader:
+		uploader.put([path, compression.variantPath(path)] if fileSaved > 0 else [path])
+
+if remoteHelper and not disableSendingChanges:
+	# the collection is matched and FILELIST is updated on the server
+	outputDir = tempDir
+	if args.collection_exact:
+		uploader = HelperUploader(args.collection_exact[0], True, args.restart)
+	elif args.collection:
+		uploader = HelperUploader(args.collection[0], False, args.restart)
+	else:
+		uploader = HelperUploader(None, False, args.restart)
 
-# send files to remote server
-if not disableSendingChanges:
-	print("Trying to send " + str(len(filesToUpdate)) + " files...")
+	filesToUpdate = convertFiles(fileList, outputDir, args.jobs, sendFile)
+	if saved > 0:
+		print("Compressed variants save %d kB." % (saved // 1024))
 
-	commandList = ["scp", "-rC"]
+	print("Waiting for " + str(len(filesToUpdate)) + " files to be sent...")
+	if not uploader.close():
+		print("Error. Could not send files. Preserving " + tempDir + " and original files.")
+		exit(1)
+	print("OK.")
 
-	commandList.extend(updateList)
-	commandList.append(os.path.join(tempDir, metadataFileName))
+	shutil.rmtree(tempDir)
+else:
+	# check if it's possible to download the .ini file with metadata
+	print("Trying to download actual file list...")
+	ret = subprocess.call(["scp"] + sshOptions + [remotePath + "/" + metadataFileName, tempDir])  # , stdout = devNull, stderr = devNull)
+	if ret != 0:
+		print("Cannot download " + metadataFileName)
+		exit(1)
 
-	commandList.append(remotePath)
-	ret = subprocess.call(commandList)  # , stdout = devNull, stderr = devNull)
-	if ret == 0:
-		print("OK.")
+	# the change log doesn't exist until the first update made by the new version, the journal holds the changes
+	# not yet written to FILELIST, the sizes and hashes of the files are only in FILELIST.jsonl
+	changesFileName = metadataFileName + filelist.changesSuffix
+	with open(os.devnull, "w") as devNull:
+		for fileName in (changesFileName, metadataFileName + filelist.journalSuffix, metadataFileName + filelist.compactSuffix):
+			subprocess.call(["scp"] + sshOptions + [remotePath + "/" + fileName, tempDir], stdout = devNull, stderr = devNull)
+
+	if args.collection_exact:
+		collection = resolveCollection(os.path.join(tempDir, metadataFileName), args.collection_exact[0], True)
+	elif args.collection:
+		collection = resolveCollection(os.path.join(tempDir, metadataFileName), args.collection[0], False)
 	else:
-		print("Error. Preserving " + tempDir + " and original files.")
-		exit(1)
+		collection = resolveCollection(os.path.join(tempDir, metadataFileName))
+	collectionDirectory = getCollectionDirectory(collection)
+
+	# the files are converted straight into the collection directory and each one is sent as soon as it's ready
+	outputDir = os.path.join(tempDir, collectionDirectory)
+	if collectionDirectory:
+		os.mkdir(outputDir)
+		if not disableSendingChanges and makeRemoteDirectory(collectionDirectory) != 0:
+			print("Error. Could not create remote directory. Preserving original files.")
+			exit(1)
+
+	uploader = Uploader(collectionDirectory) if not disableSendingChanges else None
+
+	filesToUpdate = convertFiles(fileList, outputDir, args.jobs, sendFile)
+	if saved > 0:
+		print("Compressed variants save %d kB." % (saved // 1024))
+
+	# FILELIST is updated while the last files are still being sent
+	updateMetadataFile(os.path.join(tempDir, metadataFileName), outputDir, filesToUpdate, args.restart, collection)
+
+	# send metadata to remote server, only when all files are there
+	if not disableSendingChanges:
+		print("Waiting for " + str(len(filesToUpdate)) + " files to be sent...")
+		if not uploader.close():
+			print("Error. Could not send files. Preserving " + tempDir + " and original files.")
+			exit(1)
+
+		if len(withoutVariant) > 0 and removeRemoteVariants(collectionDirectory, withoutVariant) != 0:
+			print("Error. Could not remove old compressed variants. Preserving " + tempDir + " and original files.")
+			exit(1)
+
+		commandList = ["scp", "-C"] + sshOptions
+
+		if os.path.exists(os.path.join(tempDir, changesFileName)):
+			commandList.append(os.path.join(tempDir, changesFileName))
+		# the INI file goes last, it's the one the older Kindle scripts read
+		compactPath = os.path.join(tempDir, metadataFileName + filelist.compactSuffix)
+		for path in (compression.variantPath(compactPath), compactPath, compression.variantPath(os.path.join(tempDir, metadataFileName))):
+			if os.path.exists(path):
+				commandList.append(path)
+		commandList.append(os.path.join(tempDir, metadataFileName))
+
+		commandList.append(remotePath)
+		ret = subprocess.call(commandList)  # , stdout = devNull, stderr = devNull)
+		if ret == 0:
+			print("OK.")
+		else:
+			print("Error. Preserving " + tempDir + " and original files.")
+			exit(1)
 
-	shutil.rmtree(tempDir)
+		shutil.rmtree(tempDir)
 
 if args.delete:
 	for (c, originalFile, n) in fileList:
@@ -0,0 +1,319 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of libupdate.py without Kindle and Whispernet.
+
+Starts the local HTTP server which stands in for the Amazon proxy and the library on the shell account: it checks
+the x-fsn header, supports the ranges and validators and can be slowed down to the given bandwidth and latency.
+The synthetic library is published with filelist.py, the same way as extract.py does it. libupdate.py is copied
+to the temporary /mnt/us layout and run with MAILBOOK_DEVEL pointing there, its http_proxy is the local server,
+so the requests take the same path as through the Amazon proxy. The full update, the update after
+a few changes, the no-op update and -g regeneration are timed and the results are saved as JSON.
+
+Runs on the development machine with Python 3, libupdate.py is run by the interpreter given by --python.
+
+(C) 2013 Michał Słomkowski
+https://github.com/slomkowski/mailbook
+
+"""
+
+import argparse
+import http.server
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'on_shell_account'))
+
+import compression
+import filelist
+from benchmarking import parseSize, printComparison
+
+scriptPath = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'libupdate.py')
+xfsn = 'mailbook-benchmark'
+# TreeSnapshot.mtimeResolution of libupdate.py, the directories modified that shortly before the snapshot are listed again
+snapshotResolution = 2
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+	"""Serves the files from the server root. Accepts both the absolute URL sent to the proxy and the plain path."""
+
+	protocol_version = 'HTTP/1.1'
+	# headers and body are written separately, Nagle's algorithm would delay each response until the client's delayed ACK
+	disable_nagle_algorithm = True
+
+	def log_message(self, format, *args):
+		pass
+
+	def sendEmpty(self, status, headers = {}):
+		self.send_response(status)
+		for name, value in headers.items():
+			self.send_header(name, value)
+		self.send_header('Content-Length', '0')
+		self.end_headers()
+
+	def do_GET(self):
+		server = self.server
+		server.count('requests')
+		if server.latency > 0:
+			time.sleep(server.latency)
+
+		if self.headers.get('x-fsn') != xfsn:
+			server.count('rejected')
+			self.sendEmpty(403)
+			return
+
+		# libupdate.py sends the absolute URL, as to the Amazon proxy
+		if urllib.parse.urlsplit(self.path).netloc:
+			server.count('proxy_requests')
+		relativePath = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path).lstrip('/')
+		path = os.path.realpath(os.path.join(server.root, relativePath))
+		if not path.startswith(server.root + os.sep) or not os.path.isfile(path):
+			self.sendEmpty(404)
+			return
+
+		with open(path, 'rb') as f:
+			data = f.read()
+		stat = os.stat(path)
+		etag = '"%x-%x"' % (stat.st_size, stat.st_mtime_ns)
+		if self.headers.get('If-None-Match') == etag:
+			self.sendEmpty(304, {'ETag' : etag})
+			return
+
+		rangeHeader = self.headers.get('Range')
+		ifRange = self.headers.get('If-Range')
+		status = 200
+		headers = {'ETag' : etag}
+		if rangeHeader is not None and (ifRange is None or ifRange == etag):
+			start = int(re.match(r'bytes=(\d+)-', rangeHeader).group(1))
+			if start >= len(data):
+				self.sendEmpty(416, {'Content-Range' : 'bytes */%d' % len(data)})
+				return
+			status = 206
+			headers['Content-Range'] = 'bytes %d-%d/%d' % (start, len(data) - 1, len(data))
+			data = data[start:]
+
+		self.send_response(status)
+		for name, value in headers.items():
+			self.send_header(name, value)
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.sendBody(data)
+		server.count('bytes_sent', len(data))
+
+	def sendBody(self, data):
+		"""Writes the body in chunks, each connection is limited to the bandwidth of the server."""
+		chunkSize = 8192
+		for offset in range(0, len(data), chunkSize):
+			chunk = data[offset:offset + chunkSize]
+			self.wfile.write(chunk)
+			if self.server.bandwidth > 0:
+				time.sleep(len(chunk) / self.server.bandwidth)
+
+class StandInServer(http.server.ThreadingHTTPServer):
+	daemon_threads = True
+
+	def __init__(self, root, bandwidth, latency):
+		http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+		self.root = os.path.realpath(root)
+		# bytes per second, 0 means no limit
+		self.bandwidth = bandwidth
+		self.latency = latency
+		self.lock = threading.Lock()
+		self.counters = {}
+
+	def count(self, name, value = 1):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + value
+
+	def takeCounters(self):
+		with self.lock:
+			counters = self.counters
+			self.counters = {}
+		return counters
+
+def collectionDirectory(collection):
+	"""The same directory name as convertToFileName() in libupdate.py gives for the generated names."""
+	return collection.lower().replace(' ', '_')
+
+def publishBooks(libraryPath, books, rnd, args):
+	"""Writes the books [(collection, file name, size)] with their compressed variants and adds them to FILELIST."""
+	timestamp = time.strftime("%Y-%m-%d_%H:%M:%S", time.gmtime())
+	contents = []
+	for collection, fileName, size in books:
+		directory = os.path.join(libraryPath, collectionDirectory(collection))
+		os.makedirs(directory, exist_ok = True)
+		path = os.path.join(directory, fileName)
+		# part of the content is repeated, so the compressed variants are kept for some of the books
+		randomPart = int(size * (1 - args.compressible))
+		with open(path, 'wb') as f:
+			f.write(rnd.randbytes(randomPart) + b'mailbook ' * ((size - randomPart) // 9 + 1))
+			f.truncate(size)
+		compression.writeVariant(path, 0.1)
+		contents.append(filelist.describeFile(path))
+
+	with filelist.transaction(os.path.join(libraryPath, 'FILELIST')) as tr:
+		for (collection, fileName, size), content in zip(books, contents):
+			tr.set(collection, fileName, timestamp, content)
+
+def generateLibrary(libraryPath, args):
+	rnd = random.Random(args.seed)
+	sizes = [parseSize(size) for size in args.sizes.split(',')]
+	collections = ['Collection %d' % i for i in range(args.collections)]
+	books = [(rnd.choice(collections), 'book_%d.mobi' % i, rnd.choice(sizes)) for i in range(args.files)]
+	publishBooks(libraryPath, books, rnd, args)
+	return rnd
+
+def makeUserDirectory(workDir, serverAddress, args):
+	"""Creates /mnt/us layout: the script, its configuration, the cookie with X-FSN and empty collections."""
+	userDirectory = os.path.join(workDir, 'us')
+	os.makedirs(os.path.join(userDirectory, 'documents'))
+	os.makedirs(os.path.join(userDirectory, 'system'))
+	shutil.copy(scriptPath, userDirectory)
+	# Kindle always has the collections file, even without collections
+	with open(os.path.join(userDirectory, 'system', 'collections.json'), 'w') as f:
+		f.write("{}")
+
+	cookiePath = os.path.join(workDir, 'cookie')
+	with open(cookiePath, 'w') as f:
+		f.write("x-fsn=%s\n" % xfsn)
+
+	with open(os.path.join(userDirectory, 'libupdate.ini'), 'w') as f:
+		f.write("[DEFAULT]\n")
+		f.write("remote_library=http://%s:%d/library\n" % serverAddress)
+		f.write("http_proxy=%s:%d\n" % serverAddress)
+		f.write("cookie_file=%s\n" % cookiePath)
+		f.write("preserve_existing_collections=1\n")
+		f.write("parallel_downloads=%d\n" % args.parallel_downloads)
+	return userDirectory
+
+def runUpdate(userDirectory, server, options, args):
+	"""Runs libupdate.py and returns its wall time, the requests served and the profile written by it."""
+	env = dict(os.environ, MAILBOOK_DEVEL = userDirectory)
+	server.takeCounters()
+	start = time.monotonic()
+	process = subprocess.run([args.python, os.path.join(userDirectory, 'libupdate.py'), '-n', '--profile'] + options,
+		stdout = subprocess.PIPE, stderr = subprocess.STDOUT, env = env)
+	seconds = time.monotonic() - start
+	if process.returncode != 0:
+		sys.stderr.write(process.stdout.decode('utf-8', 'replace'))
+		raise RuntimeError("libupdate.py %s exited with code %d." % (' '.join(options), process.returncode))
+
+	with open(os.path.join(userDirectory, 'mailbook-profile.log')) as f:
+		profile = json.loads(f.readlines()[-1])
+	return {
+		'seconds' : seconds,
+		'server' : server.takeCounters(),
+		'phases' : profile['phases'],
+		'counters' : profile['counters'],
+		}
+
+def waitForSnapshot():
+	"""Waits until the directories written by the previous run are older than the snapshot resolution, as they are
+	between the real runs on Kindle. The directories written by the run are listed again in the next one anyway,
+	but without the pause the run after that would list them again too.
+	"""
+	time.sleep(snapshotResolution + 0.1)
+
+def getVersion():
+	with open(scriptPath) as f:
+		return re.search(r"__version__ = '([^']*)'", f.read()).group(1)
+
+def countDocuments(userDirectory):
+	return sum(len(files) for directory, dirs, files in os.walk(os.path.join(userDirectory, 'documents')))
+
+def compareResults(old, new):
+	"""Prints the changes between two result files."""
+	rows = []
+	for run in sorted(new['result']):
+		if run not in old['result']:
+			continue
+		rows.append((run, old['result'][run]['seconds'], new['result'][run]['seconds']))
+		for phase in sorted(new['result'][run]['phases']):
+			rows.append(("  " + phase, old['result'][run]['phases'].get(phase), new['result'][run]['phases'][phase]))
+	printComparison(rows)
+
+def parseCommandLineArgs():
+	parser = argparse.ArgumentParser(description = "Benchmark of the mailbook libupdate.py against the local stand-in of the proxy.")
+	parser.add_argument("-n", "--files", type = int, default = 2000, help = "number of files in the library")
+	parser.add_argument("-c", "--collections", type = int, default = 20, help = "number of collections")
+	parser.add_argument("-s", "--sizes", default = "2k,20k", help = "comma separated file sizes to choose from, e.g. 10k,1M")
+	parser.add_argument("--compressible", type = float, default = 0.5, help = "part of each file which compresses well")
+	parser.add_argument("--changes", type = int, default = 10, help = "number of files published before the incremental update")
+	parser.add_argument("-b", "--bandwidth", type = float, default = 0, help = "kilobytes per second of each connection, 0 means no limit")
+	parser.add_argument("-l", "--latency", type = float, default = 0, help = "milliseconds added to each request")
+	parser.add_argument("-d", "--parallel-downloads", type = int, default = 2, help = "parallel_downloads option of libupdate.ini")
+	parser.add_argument("--python", default = "python2.7", help = "Python 2.7 interpreter which runs libupdate.py")
+	parser.add_argument("--seed", type = int, default = 1)
+	parser.add_argument("--keep", action = 'store_true', help = "don't remove the working directory")
+	parser.add_argument("-o", "--output", help = "save the results to this JSON file")
+	parser.add_argument("--compare", nargs = 2, metavar = ("OLD", "NEW"), help = "compare two result files and exit")
+	return parser.parse_args()
+
+if __name__ == '__main__':
+	args = parseCommandLineArgs()
+
+	if args.compare:
+		with open(args.compare[0]) as old, open(args.compare[1]) as new:
+			compareResults(json.load(old), json.load(new))
+		sys.exit(0)
+
+	workDir = tempfile.mkdtemp('mailbook-kindle-benchmark')
+	serverRoot = os.path.join(workDir, 'server')
+	libraryPath = os.path.join(serverRoot, 'library')
+	os.makedirs(libraryPath)
+
+	server = StandInServer(serverRoot, args.bandwidth * 1024, args.latency / 1000.0)
+	serverThread = threading.Thread(target = server.serve_forever)
+	serverThread.daemon = True
+	serverThread.start()
+
+	result = {}
+	try:
+		print("Generating %d files in %d collections in %s ..." % (args.files, args.collections, workDir))
+		rnd = generateLibrary(libraryPath, args)
+		userDirectory = makeUserDirectory(workDir, server.server_address, args)
+
+		print("Running the full update ...")
+		result['update'] = runUpdate(userDirectory, server, [], args)
+
+		print("Running the update after %d changes ..." % args.changes)
+		waitForSnapshot()
+		publishBooks(libraryPath, [('Collection 0', 'new_book_%d.mobi' % i, parseSize(args.sizes.split(',')[0])) for i in range(args.changes)], rnd, args)
+		result['incremental'] = runUpdate(userDirectory, server, [], args)
+
+		print("Running the update without changes ...")
+		result['noop'] = runUpdate(userDirectory, server, [], args)
+		if result['noop']['counters'].get('directories_from_snapshot', 0) == 0:
+			raise RuntimeError("The update without changes didn't use the directory snapshot.")
+
+		print("Running the regeneration of collections ...")
+		result['generate'] = runUpdate(userDirectory, server, ['-g'], args)
+
+		documents = countDocuments(userDirectory)
+	finally:
+		server.shutdown()
+		server.server_close()
+		if not args.keep:
+			shutil.rmtree(workDir)
+
+	report = {
+		'version' : getVersion(),
+		'timestamp' : time.strftime("%Y-%m-%d_%H:%M:%S", time.localtime()),
+		'parameters' : dict((key, value) for key, value in vars(args).items() if key not in ('output', 'compare', 'keep')),
+		'documents' : documents,
+		'result' : result,
+		}
+
+	print(json.dumps(report, indent = 1, sort_keys = True))
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(report, f, indent = 1, sort_keys = True)
+		print("Results saved to " + args.output)
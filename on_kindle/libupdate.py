@@ -15,13 +15,22 @@ import os
 import os.path
 import ConfigParser
 import argparse
+import atexit
 import sys
-import urllib2
-import datetime
+import httplib
+import urlparse
+import socket
+import threading
+import Queue
+import StringIO
+import zlib
+import calendar
 import time
 import hashlib
 import json
 import subprocess
+import shutil
+import contextlib
 
 __version__ = '1.1'
 __author__ = 'Michał Słomkowski'
@@ -32,18 +41,33 @@ userAgent = 'Mozilla/4.0 (compatible; Linux 2.6.22) NetFront/3.4 Kindle/2.5 (scr
 validFileExtensions = ('.txt', '.mobi', '.azw', '.azw2', '.pdf')
 
 userDirectory = '/mnt/us/'
-localLibraryPath = os.path.join(userDirectory, 'documents')
-jsonFilePath = os.path.join(userDirectory, "system/collections.json")
-metadataFileName = 'FILELIST'
-configFileName = 'libupdate.ini'
 useProxy = True
 
-# for development only
-DEVEL = False
+# for development only: MAILBOOK_DEVEL=<directory> uses the directory instead of /mnt/us, connects to the library
+# without the proxy unless http_proxy is set in the configuration and doesn't reboot or refresh Kindle.
+# The paths below are computed from userDirectory.
+DEVEL = 'MAILBOOK_DEVEL' in os.environ
 
 if DEVEL:
-	useProxy = False
-	userDirectory = '/shared/kindle'
+	userDirectory = os.environ['MAILBOOK_DEVEL'] or '/shared/kindle'
+
+localLibraryPath = os.path.join(userDirectory, 'documents')
+jsonFilePath = os.path.join(userDirectory, "system/collections.json")
+hashCacheFilePath = os.path.join(userDirectory, "system/mailbook-hashes.json")
+treeSnapshotFilePath = os.path.join(userDirectory, "system/mailbook-tree.json")
+remoteMetadataFilePath = os.path.join(userDirectory, "system/mailbook-FILELIST")
+metadataStateFilePath = os.path.join(userDirectory, "system/mailbook-FILELIST.json")
+contentIndexFilePath = os.path.join(userDirectory, "system/mailbook-contents.json")
+collectionsStateFilePath = os.path.join(userDirectory, "system/mailbook-collections.json")
+profileLogFilePath = os.path.join(userDirectory, "mailbook-profile.log")
+metadataFileName = 'FILELIST'
+# the same metadata in the compact format, JSON lines
+compactMetadataFileName = metadataFileName + '.jsonl'
+changesFileName = metadataFileName + '.changes'
+journalFileName = metadataFileName + '.journal'
+# suffix of the compressed variants of the files published on the shell account
+variantSuffix = '.gz'
+configFileName = 'libupdate.ini'
 
 # CODE
 
@@ -105,18 +129,542 @@ def getXfsn(cookieFilePath):
 
 	return xfsn
 
-def getRemoteFile(relativePath):
-	"""Downloads file from remote HTTP server using defined proxy. Takes relative path as an argument.
+class Profile:
+	"""Time spent in each phase of the run, counters and bytes downloaded per file. With profiling enabled,
+	the summary is appended to the log file as one JSON line, so the runs can be compared later.
+	"""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.startTime = time.time()
+		self.phases = {}
+		self.counters = {}
+		self.files = {}
+
+	@contextlib.contextmanager
+	def phase(self, name):
+		start = time.time()
+		try:
+			yield
+		finally:
+			elapsed = time.time() - start
+			with self.lock:
+				self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+	def count(self, name, value = 1):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + value
+
+	def downloaded(self, relativePath, received):
+		with self.lock:
+			self.files[relativePath] = self.files.get(relativePath, 0) + received
+			self.counters['download_bytes'] = self.counters.get('download_bytes', 0) + received
+
+	def append(self, path, mode):
+		with self.lock:
+			line = json.dumps({
+				'timestamp' : int(self.startTime),
+				'version' : __version__,
+				'mode' : mode,
+				'seconds' : time.time() - self.startTime,
+				'phases' : self.phases,
+				'counters' : self.counters,
+				'files' : self.files,
+				}, sort_keys = True)
+		with open(path, 'a') as fp:
+			fp.write(line + "\n")
+
+profile = Profile()
+
+# the download threads print the progress at the same time, each line is written under the lock
+outputLock = threading.Lock()
+
+class HTTPError(IOError):
+
+	def __init__(self, status, reason):
+		IOError.__init__(self, "HTTP error %d %s" % (status, reason))
+		self.status = status
+
+class Connection:
+	"""Keep-alive HTTP connection to the proxy (or directly to the server if the proxy is not used).
+	The connection is opened again if the server closed it.
+	"""
+
+	def __init__(self):
+		self.conn = None
+
+	def open(self):
+		if useProxy:
+			host = CONF('http_proxy')
+		else:
+			host = urlparse.urlsplit(CONF('remote_library')).netloc
+		return httplib.HTTPConnection(host, timeout = 60)
+
+	def get(self, relativePath, extraHeaders = {}, acceptedStatus = (200,)):
+		"""Sends GET request for the file and returns the response. The response has to be read fully before the next request."""
+		url = CONF('remote_library') + "/" + relativePath
+		parts = urlparse.urlsplit(url)
+		# the proxy needs the absolute URL
+		path = url if useProxy else urlparse.urlunsplit(('', '', parts.path, parts.query, ''))
+		headers = {'x-fsn' : xfsn, 'Host' : parts.netloc, 'User-Agent' : userAgent}
+		headers.update(extraHeaders)
+
+		with outputLock:
+			print("* Downloading: " + url)
+		for attempt in (1, 2):
+			if self.conn is None:
+				self.conn = self.open()
+			try:
+				self.conn.request('GET', path, headers = headers)
+				resp = self.conn.getresponse()
+				break
+			except (httplib.HTTPException, socket.error):
+				self.close()
+				# the kept connection could have been closed by the server in the meantime
+				if attempt == 2:
+					raise
+
+		if resp.status not in acceptedStatus:
+			resp.read()
+			raise HTTPError(resp.status, resp.reason)
+		return resp
+
+	def close(self):
+		if self.conn is not None:
+			self.conn.close()
+			self.conn = None
+
+def getValidators(resp):
+	return {'etag' : resp.getheader('etag'), 'last-modified' : resp.getheader('last-modified')}
+
+def conditionalHeaders(validators):
+	"""Returns the headers which make the server answer 304 if the file didn't change since validators were taken."""
+	headers = {}
+	if validators:
+		if validators.get('etag'):
+			headers['If-None-Match'] = validators['etag']
+		if validators.get('last-modified'):
+			headers['If-Modified-Since'] = validators['last-modified']
+	return headers
+
+def toEpoch(dateString):
+	"""Converts the FILELIST timestamp to seconds since epoch, the same way as filelist.py does."""
+	return calendar.timegm(time.strptime(dateString.split()[0], "%Y-%m-%d_%H:%M:%S"))
+
+def parseEntry(value):
+	"""Parses the INI FILELIST entry. Returns the tuple (timestamp, size, sha1, variant), timestamp in seconds since epoch.
+	The INI file holds only the timestamps, so size and sha1 are None unless the entry is 'timestamp size sha1'.
+	"""
+	fields = value.split()
+	if len(fields) >= 3:
+		return (toEpoch(fields[0]), int(fields[1]), fields[2], len(fields) >= 4 and fields[3] == '1')
+	return (toEpoch(fields[0]), None, None, False)
+
+class Metadata:
+	"""Content of FILELIST: the entry (timestamp, size, sha1, variant) of each file in each collection, the restart
+	timestamp and the sequence number. variant is True if the server has the compressed variant of the file.
+	It's read from the compact format written by filelist.py or from the INI file, and saved in the compact format:
+	the header {"sequence": ..., "restart": ...} and [collection, file, timestamp, size, sha1, variant] line for each
+	file, sorted by collection and file name. Strings are kept as UTF-8 byte strings.
+	"""
+
+	def __init__(self):
+		self.collections = {}
+		self.restart = None
+		self.sequence = 0
+
+	def get(self, collection, fileName):
+		"""Returns the entry (timestamp, size, sha1, variant) of the file or None."""
+		return self.collections.get(collection, {}).get(fileName)
+
+	def set(self, collection, fileName, entry):
+		# the INI file names are in lowercase, as ConfigParser keeps them
+		self.collections.setdefault(collection, {})[fileName.lower()] = entry
+
+	def remove(self, collection, fileName):
+		files = self.collections.get(collection, {})
+		files.pop(fileName, None)
+		if len(files) == 0:
+			self.collections.pop(collection, None)
+
+	def collectionNames(self):
+		return [name for name in self.collections if not re.match(r'___\w+___', name)]
+
+	def sortedEntries(self):
+		"""Returns the list of tuples (collection, file name, entry) sorted by collection and file name."""
+		return sorted((collection, fileName, entry) for collection, files in self.collections.items() for fileName, entry in files.items())
+
+	def read(self, fp):
+		"""Reads the compact format or the INI file, recognized by the first character."""
+		content = fp.read()
+		if content.lstrip().startswith('{'):
+			self.readCompact(content)
+		else:
+			self.readIni(content)
+
+	def readCompact(self, content):
+		lines = content.splitlines()
+		header = json.loads(lines[0])
+		self.sequence = header.get('sequence') or 0
+		self.restart = header.get('restart')
+		for line in lines[1:]:
+			# the files written by the older versions have no variant field
+			collection, fileName, timestamp, size, sha1, variant = (json.loads(line) + [False])[:6]
+			self.set(collection.encode('utf-8'), fileName.encode('utf-8'), (timestamp, size, sha1.encode('ascii') if sha1 else None, bool(variant)))
+
+	def readIni(self, content):
+		parser = ConfigParser.RawConfigParser()
+		parser.readfp(StringIO.StringIO(content))
+		for section in parser.sections():
+			if section != '___SPECIAL___':
+				for fileName, value in parser.items(section):
+					self.set(section, fileName, parseEntry(value))
+		if parser.has_option('___SPECIAL___', 'RestartTimeStamp'):
+			self.restart = toEpoch(parser.get('___SPECIAL___', 'RestartTimeStamp'))
+		if parser.has_option('___SPECIAL___', 'Sequence'):
+			self.sequence = parser.getint('___SPECIAL___', 'Sequence')
+
+	def write(self, fp):
+		fp.write(json.dumps({'sequence' : self.sequence, 'restart' : self.restart}) + "\n")
+		for collection, fileName, (timestamp, size, sha1, variant) in self.sortedEntries():
+			fp.write(json.dumps([collection, fileName, timestamp, size, sha1, variant]) + "\n")
+
+def loadMetadata(path):
+	"""Returns the metadata from the file, empty if the file doesn't exist or can't be read."""
+	metadata = Metadata()
+	try:
+		with open(path) as fp:
+			metadata.read(fp)
+	except (IOError, ValueError, TypeError, ConfigParser.Error) as exp:
+		if os.path.exists(path):
+			print >> sys.stderr, ("Could not read %s: %s" % (path, str(exp)))
+		metadata = Metadata()
+	return metadata
+
+def saveMetadata(metadata, path):
+	with open(path + '.tmp', 'w') as fp:
+		metadata.write(fp)
+	os.rename(path + '.tmp', path)
+
+def applyChangeRecord(metadata, record):
+	"""Applies the record of the change log written by filelist.py on the shell account."""
+	if 'restart' in record:
+		metadata.restart = toEpoch(record['restart'])
+	else:
+		metadata.set(record['collection'].encode('utf-8'), record['file'].encode('utf-8'),
+			(toEpoch(record['timestamp']), record.get('size'), record['sha1'].encode('ascii') if 'sha1' in record else None,
+			record.get('variant', False)))
+
+def fetchChanges(connection, metadata, state):
+	"""Downloads the part of the change log after state['changesOffset'] and applies the transactions newer than
+	the sequence number of metadata. If the part doesn't follow the sequence (the log was cut on the server), the whole
+	log is downloaded. Returns False if the log doesn't reach back to the sequence number.
+	"""
+	sequence = metadata.sequence
+	offset = state.get('changesOffset')
+
+	while True:
+		headers = conditionalHeaders(state.get('changesValidators'))
+		if offset:
+			headers['Range'] = 'bytes=%d-' % offset
+		resp = connection.get(changesFileName, headers, (200, 206, 304, 416))
+		body = resp.read()
+		profile.count('metadata_bytes', len(body))
+
+		if resp.status == 304:
+			return True
+		if resp.status == 416:
+			# nothing was appended, unless the log was cut and it's shorter than the offset now
+			if resp.getheader('content-range', '').split('/')[-1] == str(offset):
+				return True
+			offset = None
+			continue
+		if resp.status == 200:
+			offset = 0
+
+		# the transaction being written at the moment is left for the next run
+		complete = body[:body.rfind("\n") + 1]
+		try:
+			transactions = [json.loads(line) for line in complete.splitlines()]
+			continuous = len(transactions) == 0 or transactions[0]['sequence'] <= sequence + 1
+		except (ValueError, KeyError, TypeError):
+			continuous = False
+
+		if continuous:
+			break
+		if not offset:
+			return False
+		offset = None
+
+	applied = 0
+	for transaction in transactions:
+		if transaction['sequence'] > sequence:
+			for record in transaction['records']:
+				applyChangeRecord(metadata, record)
+			sequence = transaction['sequence']
+			applied += 1
+
+	metadata.sequence = sequence
+	state['sequence'] = sequence
+	state['changesOffset'] = offset + len(complete)
+	state['changesValidators'] = getValidators(resp)
+	print("Applied %d metadata changes." % applied)
+	return True
+
+def fetchJournal(connection, metadata, state):
+	"""Applies the transactions from the journal of FILELIST, which holds all of them since FILELIST.jsonl was written.
+	Used when the change log doesn't reach back to the sequence number of metadata. Raises IOError if the journal
+	doesn't reach back either.
+	"""
+	try:
+		resp = connection.get(journalFileName)
+		body = resp.read()
+	except HTTPError as exp:
+		if exp.status != 404:
+			raise
+		body = ''
+	profile.count('metadata_bytes', len(body))
+
+	transactions = []
+	records = []
+	for line in body.splitlines(True):
+		try:
+			if not line.endswith("\n"):
+				raise ValueError
+			record = json.loads(line)
+		except ValueError:
+			# torn write, nothing after it was committed
+			break
+		if record.get('commit'):
+			transactions.append((record.get('sequence'), records))
+			records = []
+		else:
+			records.append(record)
+
+	sequences = [sequence for sequence, records in transactions if sequence is not None]
+	if len(sequences) == 0 or sequences[0] > metadata.sequence + 1:
+		raise IOError("Metadata changes after sequence %d are not available." % metadata.sequence)
+
+	applied = 0
+	for sequence, records in transactions:
+		if sequence is not None and sequence > metadata.sequence:
+			for record in records:
+				applyChangeRecord(metadata, record)
+			metadata.sequence = sequence
+			applied += 1
+
+	# the next run reads the whole change log again
+	state['sequence'] = metadata.sequence
+	state.pop('changesOffset', None)
+	state.pop('changesValidators', None)
+	print("Applied %d metadata changes from the journal." % applied)
+
+def fetchMetadata(connection, metadata, state):
+	"""Brings metadata, the copy of the remote FILELIST from the previous run, up to date. Only the new part of the change
+	log is downloaded if possible, otherwise the whole FILELIST. All requests are conditional, so the unchanged file costs
+	only the headers. Returns the tuple (metadata, state) to be saved for the next run.
+	"""
+	if state.get('sequence') != metadata.sequence:
+		# the copy and the state don't match, start from scratch
+		state = {}
+
+	if state.get('sequence'):
+		try:
+			if fetchChanges(connection, metadata, state):
+				return (metadata, state)
+			print("Metadata history is not available, downloading the whole file.")
+		except (IOError, httplib.HTTPException, socket.error) as exp:
+			print("Could not download metadata changes: " + str(exp))
+
+	# the compact format and the compressed variants first, the servers updated by the older versions have only the INI file
+	for name in (compactMetadataFileName + variantSuffix, compactMetadataFileName, metadataFileName + variantSuffix, metadataFileName):
+		headers = conditionalHeaders(state.get('metadataValidators')) if state.get('metadataName') == name else {}
+		try:
+			resp = connection.get(name, headers, (200, 304))
+			break
+		except HTTPError as exp:
+			if exp.status != 404 or name == metadataFileName:
+				raise
+
+	body = resp.read()
+	profile.count('metadata_bytes', len(body))
+	if resp.status != 304:
+		if name.endswith(variantSuffix):
+			body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+		metadata = Metadata()
+		metadata.read(StringIO.StringIO(body))
+		state = {'sequence' : metadata.sequence, 'metadataName' : name, 'metadataValidators' : getValidators(resp)}
+
+	# the full file is rewritten on the server only from time to time, the newer transactions are in the change log,
+	# or in the journal if the log was cut. If the full file didn't change, the log was already checked above.
+	if metadata.sequence and (resp.status == 304 or not fetchChanges(connection, metadata, state)):
+		print("Metadata history doesn't reach the full file, reading the journal.")
+		fetchJournal(connection, metadata, state)
+	return (metadata, state)
+
+def saveRemoteMetadata(metadata, state):
+	"""Keeps the copy of the remote FILELIST and the state of fetching it for the next run."""
+	saveMetadata(metadata, remoteMetadataFilePath)
+	with open(metadataStateFilePath + '.tmp', 'w') as fp:
+		json.dump(state, fp)
+	os.rename(metadataStateFilePath + '.tmp', metadataStateFilePath)
+
+def downloadToFile(connection, relativePath, localPath, chunkSize):
+	"""Streams the remote file to localPath + '.part' in chunks and renames it into place when it is complete.
+	The part left by the interrupted download is resumed with Range request. The validator (ETag or Last-Modified)
+	of the first response is kept in '.part.validator' file, so the part is thrown away if the remote file changed.
+	Returns the number of bytes received.
+	"""
+	partPath = localPath + '.part'
+	validatorPath = partPath + '.validator'
+
+	offset = 0
+	headers = {}
+	if os.path.exists(partPath) and os.path.exists(validatorPath):
+		with open(validatorPath) as f:
+			validator = f.read().strip()
+		offset = os.path.getsize(partPath)
+		if offset > 0 and validator != '':
+			headers = {'Range' : 'bytes=%d-' % offset, 'If-Range' : validator}
+
+	resp = connection.get(relativePath, headers, (200, 206, 416))
+
+	if resp.status == 416:
+		# the part is already complete, only the rename was missing
+		resp.read()
+		total = resp.getheader('content-range', '').split('/')[-1]
+		if total.isdigit() and int(total) == offset:
+			os.rename(partPath, localPath)
+			os.remove(validatorPath)
+			return 0
+		os.remove(partPath)
+		raise IOError("Part file doesn't match the remote file.")
+
+	if resp.status == 206:
+		# Content-Range: bytes start-end/total
+		contentRange = resp.getheader('content-range', '')
+		match = re.match(r'bytes\s+(\d+)-\d+/(\d+)', contentRange)
+		if match is None or int(match.group(1)) != offset:
+			resp.read()
+			os.remove(partPath)
+			raise IOError("Unexpected Content-Range: " + contentRange)
+		expectedSize = int(match.group(2))
+		mode = 'ab'
+		with outputLock:
+			print("* Resuming from byte %d." % offset)
+	else:
+		length = resp.getheader('content-length')
+		expectedSize = int(length) if length is not None else None
+		mode = 'wb'
+		with open(validatorPath, 'w') as f:
+			f.write(resp.getheader('etag') or resp.getheader('last-modified') or '')
+
+	received = 0
+	with open(partPath, mode) as localFile:
+		while True:
+			chunk = resp.read(chunkSize)
+			if not chunk:
+				break
+			localFile.write(chunk)
+			received += len(chunk)
+
+	size = os.path.getsize(partPath)
+	if expectedSize is not None and size != expectedSize:
+		# the part is kept and resumed in the next run
+		raise IOError("Incomplete download: %d of %d bytes." % (size, expectedSize))
+
+	os.rename(partPath, localPath)
+	os.remove(validatorPath)
+	return received
+
+def decompressFile(compressedPath, localPath, chunkSize):
+	"""Decompresses the gzip file chunk by chunk and renames the result into place."""
+	tempPath = localPath + '.tmp'
+	decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+	with open(compressedPath, 'rb') as source:
+		with open(tempPath, 'wb') as localFile:
+			while True:
+				chunk = source.read(chunkSize)
+				if not chunk:
+					break
+				localFile.write(decompressor.decompress(chunk))
+			localFile.write(decompressor.flush())
+	os.rename(tempPath, localPath)
+
+def downloadFile(connection, relativePath, localPath, chunkSize, variant = False):
+	"""Downloads the compressed variant of the file if FILELIST says the server has it, the plain file otherwise.
+	Returns the tuple (bytes received, bytes saved by the compression).
 	"""
-	if useProxy:
-		os.environ['http_proxy'] = CONF('http_proxy')
-	url = CONF('remote_library') + "/" + relativePath
+	if not variant:
+		return (downloadToFile(connection, relativePath, localPath, chunkSize), 0)
 
-	request = urllib2.Request(url)
-	request.add_header('x-fsn', xfsn)
-	print("* Downloading: " + url)
-	resp = urllib2.urlopen(request)
-	return resp
+	compressedPath = localPath + variantSuffix
+	try:
+		received = downloadToFile(connection, relativePath + variantSuffix, compressedPath, chunkSize)
+	except HTTPError as exp:
+		if exp.status != 404:
+			raise
+		return (downloadToFile(connection, relativePath, localPath, chunkSize), 0)
+
+	try:
+		decompressFile(compressedPath, localPath, chunkSize)
+	finally:
+		compressedSize = os.path.getsize(compressedPath)
+		os.remove(compressedPath)
+	return (received, os.path.getsize(localPath) - compressedSize)
+
+def downloadFiles(filesToDownloadList, metadata, parallelDownloads, chunkSize):
+	"""Downloads the files from the list returned by generateFilesToDownloadList, metadata tells which ones
+	have the compressed variant. Several files are downloaded at the same time,
+	each thread keeps its own connection to the proxy. Returns the list of (collection, fileName) which failed.
+	"""
+	jobs = Queue.Queue()
+	for collection, collDir, fileList in filesToDownloadList:
+		for fileName in fileList:
+			jobs.put((collection, collDir, fileName))
+
+	failed = []
+	# [bytes received, bytes saved by the compression]
+	transferred = [0, 0]
+	failedLock = threading.Lock()
+
+	def worker():
+		connection = Connection()
+		while True:
+			try:
+				collection, collDir, fileName = jobs.get_nowait()
+			except Queue.Empty:
+				break
+			try:
+				partUrl = collDir + "/" + fileName
+				received, saved = downloadFile(connection, partUrl, os.path.join(localLibraryPath, collDir, fileName), chunkSize,
+					metadata.get(collection, fileName)[3])
+				profile.downloaded(partUrl, received)
+				profile.count('compression_saved_bytes', saved)
+				with failedLock:
+					transferred[0] += received
+					transferred[1] += saved
+			except Exception as exp:
+				connection.close()
+				with outputLock:
+					print >> sys.stderr, ("Could download %s file: %s" % (partUrl, str(exp)))
+					print >> sys.stderr, ("Omitting.")
+				with failedLock:
+					failed.append((collection, fileName))
+		connection.close()
+
+	threads = [threading.Thread(target = worker) for i in range(max(1, parallelDownloads))]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	if transferred[0] > 0:
+		print("Downloaded %d kB, compression saved %d kB." % (transferred[0] // 1024, transferred[1] // 1024))
+	return failed
+
+AsinPattern = re.compile(r'[^-]+-asin_(?P<asin>[a-zA-Z\d\-]*)-type_(?P<type>\w{4})-v_(?P<index>\d+)')
+CalibreAsin = re.compile(r'\[http://calibre-ebook\.com\].*\x00\x00\x00\x71\x00\x00\x00\x2c([a-zA-Z0-9_-]+).*(PDOC|EBOK)')
 
 def computeHashEntry(fileName):
 	"""
@@ -127,9 +675,6 @@ def computeHashEntry(fileName):
 	available at http://kindle-coll-gen.sourceforge.net/
 	"""
 
-	AsinPattern = re.compile(r'[^-]+-asin_(?P<asin>[a-zA-Z\d\-]*)-type_(?P<type>\w{4})-v_(?P<index>\d+)')
-	CalibreAsin = re.compile(r'\[http://calibre-ebook\.com\].*\x00\x00\x00\x71\x00\x00\x00\x2c([a-zA-Z0-9_-]+).*(PDOC|EBOK)')
-
 	m = AsinPattern.match(os.path.basename(fileName))
 	if m is not None:
 		hashEntry = '#' + m.group('asin') + '^' + m.group('type')
@@ -151,6 +696,58 @@ def computeHashEntry(fileName):
 					break
 	return hashEntry
 
+class HashCache:
+	"""Persistent cache of computeHashEntry results, stored as JSON file. The entry of the file is valid as long as
+	its size and mtime are the same. Entries of the files which were neither asked for nor kept during the run
+	are pruned on save.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.entries = {}
+		self.used = set()
+		self.changed = False
+		try:
+			with open(path) as fp:
+				self.entries = json.load(fp)
+		except (IOError, ValueError):
+			pass
+
+	def entry(self, fileName):
+		key = fileName.decode('utf-8', 'replace') if isinstance(fileName, str) else fileName
+		st = os.stat(fileName)
+		self.used.add(key)
+		try:
+			size, mtime, hashEntry = self.entries[key]
+			if size == st.st_size and mtime == st.st_mtime:
+				return hashEntry
+		except (KeyError, ValueError):
+			pass
+		with profile.phase('hash_entries'):
+			hashEntry = computeHashEntry(fileName)
+		profile.count('files_hashed')
+		self.entries[key] = [st.st_size, st.st_mtime, hashEntry]
+		self.changed = True
+		return hashEntry
+
+	def keep(self, fileNames):
+		"""Marks the entries of the files as used without checking them, for the collections which didn't change."""
+		for fileName in fileNames:
+			self.used.add(fileName.decode('utf-8', 'replace') if isinstance(fileName, str) else fileName)
+
+	def save(self):
+		"""Removes the entries of vanished files and writes the cache if anything changed."""
+		for key in [key for key in self.entries if key not in self.used]:
+			del self.entries[key]
+			self.changed = True
+		if not self.changed:
+			return
+		tempPath = self.path + '.tmp'
+		with open(tempPath, 'w') as fp:
+			json.dump(self.entries, fp)
+		os.rename(tempPath, self.path)
+		self.changed = False
+
 def printCollections(collections, displayFiles = False):
 	"""Displays the content of directory tree and the number of documents in each collection.
 	"""
@@ -163,51 +760,252 @@ def printCollections(collections, displayFiles = False):
 				print("  - %s" % file)
 	print(str(overallItems) + " documents in the library.")
 
-def saveToJsonFile(collections, preserveColls):
-	"""Generates collections.json file. Loads the original collection if specified.
+def saveToJsonFile(collections, preserveColls, hashCache, state, changedPaths = frozenset()):
+	"""Updates collections.json file. Loads the original collection if specified. Only the collections whose files
+	changed since the last run get new items, state is the dictionary saved in the previous run. The file is written
+	to the temporary file and renamed, so it's never left half-written. Returns True if the collections changed.
 	"""
 	global jsonFilePath
 
 	changed = False
 
-	oldJson = {}
 	js = {}
 	preserveColls = True
 	with open(jsonFilePath, 'r') as fp:
 		try:
 			if preserveColls:
 				js = json.load(fp)
-				fp.seek(0, 0)
-			oldJson = json.load(fp)
 		except ValueError:
 			pass
 
 	for colName, colFiles in collections.items():
 		colName = colName + "@en-US"
-		try:
-		 	_dummy = js[colName]["lastAccess"]
-		except KeyError:
+		if colName not in js or "lastAccess" not in js[colName]:
+			changed = True
+			js[colName] = {"lastAccess" : int(time.time() * 1000)}
+
+		# latin-1 makes the byte string paths survive the JSON round trip
+		files = [f.decode('latin-1') for f in colFiles]
+		previous = state.get(colName)
+		if previous is not None and previous['files'] == files and js[colName].get("items") == previous['items'] \
+				and not any(f in changedPaths for f in colFiles):
+			hashCache.keep(colFiles)
+			continue
+
+		items = map(hashCache.entry, colFiles)
+		if js[colName].get("items") != items:
 			changed = True
-			js[colName] = {}
-		 	js[colName]["lastAccess"] = int(time.time() * 1000)
-		js[colName]["items"] = map(computeHashEntry, colFiles)
+			js[colName]["items"] = items
+		state[colName] = {'files' : files, 'items' : items}
+
+	# collections which are gone from the directory tree are not tracked any more
+	for colName in [colName for colName in state if colName[:-len("@en-US")] not in collections]:
+		del state[colName]
+
+	if changed:
+		with open(jsonFilePath + '.tmp', "w") as fp:
+			json.dump(js, fp, sort_keys = True)
+			fp.write("\n")
+			fp.flush()
+			os.fsync(fp.fileno())
+		os.rename(jsonFilePath + '.tmp', jsonFilePath)
+
+	return changed
+
+class ContentIndex:
+	"""Persistent index of the documents downloaded by the script: path -> (size, mtime, sha1). The entry is valid
+	as long as the file has the same size and mtime, so the files changed or removed by the user are never used.
+	"""
 
-	with open(jsonFilePath, "w") as fp:
-		json.dump(js, fp, sort_keys = True)
-		fp.write("\n")
+	def __init__(self, path):
+		self.path = path
+		self.entries = {}
+		try:
+			with open(path) as fp:
+				loaded = json.load(fp)
+		except (IOError, ValueError):
+			loaded = {}
 
-	return (js != oldJson) or changed
+		for key, (size, mtime, sha1) in loaded.items():
+			try:
+				st = os.stat(key.encode('latin-1'))
+			except OSError:
+				continue
+			if st.st_size == size and st.st_mtime == mtime:
+				self.entries[key] = (size, mtime, sha1)
+		self.bySha1 = dict((sha1, key) for key, (size, mtime, sha1) in self.entries.items())
+
+	def has(self, localPath, sha1):
+		entry = self.entries.get(localPath.decode('latin-1'))
+		return entry is not None and entry[2] == sha1
+
+	def find(self, sha1):
+		"""Returns the path of the document with this content or None."""
+		key = self.bySha1.get(sha1)
+		return key.encode('latin-1') if key is not None else None
+
+	def add(self, localPath, sha1):
+		key = localPath.decode('latin-1')
+		st = os.stat(localPath)
+		self.entries[key] = (st.st_size, st.st_mtime, sha1)
+		self.bySha1[sha1] = key
+
+	def save(self):
+		with open(self.path + '.tmp', 'w') as fp:
+			json.dump(self.entries, fp)
+		os.rename(self.path + '.tmp', self.path)
+
+def reuseLocalFiles(filesToDownloadList, metadata, contentIndex):
+	"""Removes the files whose content is already on the device from the list returned by generateFilesToDownloadList.
+	The file which is in place is skipped, the copy from other place (e.g. other collection) is copied locally.
+	Returns the tuple (list of remaining files, number of skipped files, number of copied files).
+	"""
+	remaining = []
+	skipped = 0
+	copied = 0
+	for collection, collDir, fileList in filesToDownloadList:
+		toDownload = []
+		for fileName in fileList:
+			timestamp, size, sha1, variant = metadata.get(collection, fileName)
+			localPath = os.path.join(localLibraryPath, collDir, fileName)
+			if sha1 is None:
+				toDownload.append(fileName)
+			elif contentIndex.has(localPath, sha1):
+				skipped += 1
+			elif contentIndex.find(sha1) is not None:
+				print("* Copying %s from %s" % (fileName, contentIndex.find(sha1)))
+				shutil.copyfile(contentIndex.find(sha1), localPath + '.tmp')
+				os.rename(localPath + '.tmp', localPath)
+				contentIndex.add(localPath, sha1)
+				copied += 1
+			else:
+				toDownload.append(fileName)
+		if len(toDownload) > 0:
+			remaining.append((collection, collDir, toDownload))
+	return (remaining, skipped, copied)
+
+def scheduleDownloads(filesToDownloadList, metadata, order, priorities, budget):
+	"""Orders the files from the list returned by generateFilesToDownloadList and selects the ones which fit in the budget.
+	order is the list of criteria: 'priority' (collections in the order of the priorities list, the others after them),
+	'smallest' and 'oldest'; the empty list keeps the metadata order. budget is the number of bytes or 0 for no limit;
+	the files whose size is unknown are counted as empty. Returns the tuple (list of files to download in the same form,
+	list of deferred (collection, fileName), planned number of bytes).
+	"""
+	files = []
+	for collection, collDir, fileList in filesToDownloadList:
+		for fileName in fileList:
+			timestamp, size, sha1, variant = metadata.get(collection, fileName)
+			files.append((collection, collDir, fileName, timestamp, size or 0))
+
+	def key(item):
+		collection, collDir, fileName, timestamp, size = item
+		values = []
+		for criterion in order:
+			if criterion == 'priority':
+				values.append(priorities.index(collection) if collection in priorities else len(priorities))
+			elif criterion == 'smallest':
+				values.append(size)
+			elif criterion == 'oldest':
+				values.append(timestamp)
+		return values
+
+	# sort is stable, so the files equal by all criteria stay in the metadata order
+	files.sort(key = key)
+
+	scheduled = []
+	deferred = []
+	planned = 0
+	for collection, collDir, fileName, timestamp, size in files:
+		# the smaller files further in the order can still fit in the rest of the budget
+		if budget > 0 and planned + size > budget:
+			if size > budget:
+				print("* %s is larger than the download budget." % fileName)
+			deferred.append((collection, fileName))
+			continue
+		planned += size
+		if len(scheduled) == 0 or scheduled[-1][0] != collection:
+			scheduled.append((collection, collDir, []))
+		scheduled[-1][2].append(fileName)
+	return (scheduled, deferred, planned)
+
+class TreeSnapshot:
+	"""Persistent listing of the library directories: mtime, subdirectories and documents of each directory.
+	The directory is listed again only if its mtime changed or it was touched during this run. Directories modified
+	shortly before the snapshot was saved are always listed again, because FAT keeps mtime with 2 seconds resolution.
+	"""
 
-def parseDate(dateString):
-	return datetime.datetime.strptime(dateString, "%Y-%m-%d_%H:%M:%S")
+	mtimeResolution = 2
 
-def getCollections(metadataCollections):
+	def __init__(self, path, fullRescan = False):
+		self.path = path
+		self.entries = {}
+		self.savedTime = 0
+		self.touched = set()
+		self.used = set()
+		if fullRescan:
+			return
+		try:
+			with open(path) as fp:
+				content = json.load(fp)
+			self.entries = content['directories']
+			self.savedTime = content['saved']
+		except (IOError, ValueError, KeyError, TypeError):
+			self.entries = {}
+
+	def touch(self, directory):
+		self.touched.add(os.path.normpath(directory))
+
+	def listDirectory(self, directory):
+		"""Returns the tuple (subdirectories, documents) of the directory."""
+		# latin-1 makes the byte string file names survive the JSON round trip
+		key = os.path.normpath(directory).decode('latin-1')
+		mtime = os.stat(directory).st_mtime
+		self.used.add(key)
+
+		entry = self.entries.get(key)
+		if entry is not None and entry['mtime'] == mtime and mtime < self.savedTime - self.mtimeResolution \
+				and os.path.normpath(directory) not in self.touched:
+			profile.count('directories_from_snapshot')
+			return ([name.encode('latin-1') for name in entry['dirs']], [name.encode('latin-1') for name in entry['files']])
+
+		dirs = []
+		files = []
+		for name in os.listdir(directory):
+			path = os.path.join(directory, name)
+			if os.path.isdir(path):
+				# os.walk doesn't follow links either
+				if not os.path.islink(path):
+					dirs.append(name)
+			elif os.path.splitext(name)[1].lower() in validFileExtensions:
+				files.append(name)
+		self.entries[key] = {'mtime' : mtime, 'dirs' : [name.decode('latin-1') for name in dirs], 'files' : [name.decode('latin-1') for name in files]}
+		profile.count('directories_listed')
+		profile.count('files_scanned', len(files))
+		return (dirs, files)
+
+	def walk(self, directory):
+		"""Returns the paths of all documents below the directory, in the same order as os.walk."""
+		dirs, files = self.listDirectory(directory)
+		paths = [os.path.join(directory, name) for name in files]
+		for name in dirs:
+			paths.extend(self.walk(os.path.join(directory, name)))
+		return paths
+
+	def save(self):
+		"""Writes the snapshot without the directories which were not visited."""
+		directories = dict((key, entry) for key, entry in self.entries.items() if key in self.used)
+		tempPath = self.path + '.tmp'
+		with open(tempPath, 'w') as fp:
+			json.dump({'saved' : time.time(), 'directories' : directories}, fp)
+		os.rename(tempPath, self.path)
+
+def getCollections(metadataCollections, snapshot):
 	"""Iterates over directory tree in 'documents' directory and metadata file. Creates the collection list from directories.
 	If the directory name matches one of the collections from the metadata, it is used. Otherwise the name is generated.
+	Unchanged directories are taken from the snapshot.
 	"""
-	global validFileExtensions
 	# get directories
-	directoryList = [name for name in os.listdir(localLibraryPath) if os.path.isdir(os.path.join(localLibraryPath, name))]
+	directoryList = snapshot.listDirectory(localLibraryPath)[0]
 
 	metadataCollections = [(name, convertToFileName(name)) for name in metadataCollections]
 
@@ -219,36 +1017,30 @@ def getCollections(metadataCollections):
 
 	collections = {}
 	for directory, collName in [(os.path.join(localLibraryPath, dirName), makeCollName(dirName)) for dirName in directoryList]:
-		fileList = []
-		for root, dirs, files in os.walk(directory):
-			for file in files:
-				filePath = os.path.join(root, file)
-				if os.path.splitext(filePath)[1].lower() in validFileExtensions:
-					fileList.append(filePath)
-		collections[collName] = fileList
+		collections[collName] = snapshot.walk(directory)
 	return collections
 
 def generateFilesToDownloadList(oldMetadata, newMetadata):
-	"""Takes two ConfigParser objects: old and new metadata and returns the tuple of overall number of files
+	"""Takes two Metadata objects: old and new metadata and returns the tuple of overall number of files
 	and list containing (collection name, collection directory, list of files in collection to download).
+	Both sorted entry lists are walked once, side by side.
 	"""
 
 	fileList = []
-
 	counter = 0
-	for collection in [sec for sec in newMetadata.sections() if sec != '___SPECIAL___']:
-		list = []
-		for file in newMetadata.options(collection):
-			if not oldMetadata.has_option(collection, file):
-				list.append(file)
-			else:
-				dateParse = lambda metadata: parseDate(metadata.get(collection, file))
-				if dateParse(newMetadata) > dateParse(oldMetadata):
-					list.append(file)
 
-		if len(list) > 0:
-			fileList.append((collection, convertToFileName(collection) if collection != '___NO_COLLECTION___' else '', list))
-			counter += len(list)
+	oldEntries = oldMetadata.sortedEntries()
+	i = 0
+	for collection, file, entry in newMetadata.sortedEntries():
+		while i < len(oldEntries) and oldEntries[i][:2] < (collection, file):
+			i += 1
+		if i < len(oldEntries) and oldEntries[i][:2] == (collection, file) and entry[0] <= oldEntries[i][2][0]:
+			continue
+
+		if len(fileList) == 0 or fileList[-1][0] != collection:
+			fileList.append((collection, convertToFileName(collection) if collection != '___NO_COLLECTION___' else '', []))
+		fileList[-1][2].append(file)
+		counter += 1
 
 	return (counter, fileList)
 
@@ -264,23 +1056,21 @@ def parseCommandLineArgs():
 	parser.add_argument("-g", "--generate", action = 'store_true', help = """don't download updates, generate collections
 	from the local directory tree then reboot""")
 	parser.add_argument("-c", "--config", nargs = 1, help = "uses specified configuration file")
+	parser.add_argument("-p", "--profile", action = 'store_true', help = "append the timings of the run to " + profileLogFilePath)
+	parser.add_argument("--full-rescan", action = 'store_true', help = "ignore the saved directory snapshot and regenerate all collections")
 
 	return parser.parse_args()
 
 # check if reboot was selected
 def checkRebootFlag(oldMetadata, newMetadata):
-	"""Takes two ConfigParser objects: old and new metadata and returns True if reboot was sheduled.
+	"""Takes two Metadata objects: old and new metadata and returns True if reboot was sheduled.
 	"""
 
-	try:
-		newDate = parseDate(newMetadata.get("___SPECIAL___", "RestartTimeStamp"))
-	except:
+	if newMetadata.restart is None:
 		return False
-	try:
-		oldDate = parseDate(oldMetadata.get("___SPECIAL___", "RestartTimeStamp"))
-	except:
+	if oldMetadata.restart is None:
 		return True
-	return newDate > oldDate
+	return newMetadata.restart > oldMetadata.restart
 
 # MAIN
 
@@ -293,64 +1083,168 @@ config = getConfiguration(args.config)
 
 CONF = lambda key: config.get('DEFAULT', key)
 
+if DEVEL:
+	# the stand-in of the proxy is used if it's configured, so the proxy requests are tested too
+	useProxy = config.has_option('DEFAULT', 'http_proxy') and CONF('http_proxy').strip() != ''
+
+try:
+	profiling = args.profile or config.getboolean('DEFAULT', 'profile')
+except ConfigParser.NoOptionError:
+	profiling = False
+
+def writeProfile():
+	try:
+		profile.append(profileLogFilePath, 'generate' if args.generate else 'update')
+		print("Profile appended to " + profileLogFilePath)
+	except IOError as exp:
+		print >> sys.stderr, ("Could not write profile: " + str(exp))
+
+# the runs which end early with sys.exit() are recorded too
+if profiling:
+	atexit.register(writeProfile)
+
 # read actual local metadata
-oldMetadata = ConfigParser.SafeConfigParser()
-newMetadata = ConfigParser.SafeConfigParser()
+with profile.phase('metadata_load'):
+	oldMetadata = loadMetadata(os.path.join(localLibraryPath, metadataFileName))
+newMetadata = Metadata()
 
-oldMetadata.read(os.path.join(localLibraryPath, metadataFileName))
+snapshot = TreeSnapshot(treeSnapshotFilePath, args.full_rescan)
 
 if not args.generate:
 	xfsn = getXfsn(CONF('cookie_file'))
 
-	# get new metadata from remote location
+	# get new metadata from remote location, starting from the copy saved in the previous run
+	newMetadata = loadMetadata(remoteMetadataFilePath)
+	try:
+		with open(metadataStateFilePath) as fp:
+			metadataState = json.load(fp)
+	except (IOError, ValueError):
+		metadataState = {}
+
+	connection = Connection()
 	try:
-		newMetadata.readfp(getRemoteFile(metadataFileName))
+		with profile.phase('metadata_fetch'):
+			newMetadata, metadataState = fetchMetadata(connection, newMetadata, metadataState)
 	except Exception as exp:
 		print >> sys.stderr, ("Could not download metadata file: " + str(exp))
 		sys.exit(1)
+	finally:
+		connection.close()
+
+	try:
+		saveRemoteMetadata(newMetadata, metadataState)
+	except IOError as exp:
+		print >> sys.stderr, ("Could not save metadata copy: " + str(exp))
 
 	# compare old and new metadata and find files to download
-	filesToDownloadCounter, filesToDownloadList = generateFilesToDownloadList(oldMetadata, newMetadata)
+	with profile.phase('metadata_diff'):
+		filesToDownloadCounter, filesToDownloadList = generateFilesToDownloadList(oldMetadata, newMetadata)
+	updatedPaths = frozenset(os.path.join(localLibraryPath, collDir, fileName) for collection, collDir, fileList in filesToDownloadList for fileName in fileList)
+
+	# Create directories if needed.
+	for collection, collDir, fileList in filesToDownloadList:
+		snapshot.touch(os.path.join(localLibraryPath, collDir))
+		if collDir != '' and not os.path.exists(os.path.join(localLibraryPath, collDir)):
+			print("Creating directory for '" + collDir + "'")
+			os.makedirs(os.path.join(localLibraryPath, collDir))
+
+	# the content which is already on the device is not downloaded again
+	with profile.phase('content_reuse'):
+		contentIndex = ContentIndex(contentIndexFilePath)
+		filesToDownloadList, skipped, copied = reuseLocalFiles(filesToDownloadList, newMetadata, contentIndex)
+	if skipped + copied > 0:
+		print("%d files are already on the device, %d of them copied locally." % (skipped + copied, copied))
+	filesToDownloadCounter -= skipped + copied
+
+	# order the downloads and defer the ones which don't fit in the budget of this run
+	try:
+		downloadOrder = [criterion.strip() for criterion in config.get('DEFAULT', 'download_order').split(',') if criterion.strip() != '']
+	except ConfigParser.NoOptionError:
+		downloadOrder = []
+	for criterion in downloadOrder:
+		if criterion not in ('priority', 'smallest', 'oldest'):
+			print >> sys.stderr, ("Unknown download order: " + criterion)
+			sys.exit(1)
+
+	try:
+		priorities = [name.strip() for name in config.get('DEFAULT', 'collection_priority').split(';') if name.strip() != '']
+	except ConfigParser.NoOptionError:
+		priorities = []
+
+	try:
+		budget = config.getint('DEFAULT', 'download_budget') * 1024
+	except ConfigParser.NoOptionError:
+		budget = 0
+
+	filesToDownloadList, deferred, plannedBytes = scheduleDownloads(filesToDownloadList, newMetadata, downloadOrder, priorities, budget)
+	if len(deferred) > 0:
+		print("%d files deferred to the next run, the budget is %d kB." % (len(deferred), budget // 1024))
+	filesToDownloadCounter -= len(deferred)
+	profile.count('deferred_files', len(deferred))
+	profile.count('planned_bytes', plannedBytes)
 
 	if filesToDownloadCounter > 0:
 		print("Trying to download %d files..." % filesToDownloadCounter)
 	else:
 		print("No files to download.")
 
-	# Download files and create directories if needed.
+	# Download files.
+	try:
+		parallelDownloads = config.getint('DEFAULT', 'parallel_downloads')
+	except ConfigParser.NoOptionError:
+		parallelDownloads = 2
+
+	try:
+		chunkSize = config.getint('DEFAULT', 'download_chunk_size') * 1024
+	except ConfigParser.NoOptionError:
+		chunkSize = 64 * 1024
+
+	with profile.phase('downloads'):
+		failed = downloadFiles(filesToDownloadList, newMetadata, parallelDownloads, chunkSize)
+	profile.count('downloaded_files', filesToDownloadCounter - len(failed))
+	profile.count('failed_files', len(failed))
+	for collection, fileName in failed:
+		# remove entry about file in order to download it later
+		newMetadata.remove(collection, fileName)
+
+	for collection, fileName in deferred:
+		# keep the entry of the version which is on the device, the remote copy of metadata still has the new one
+		oldEntry = oldMetadata.get(collection, fileName)
+		if oldEntry is not None:
+			newMetadata.set(collection, fileName, oldEntry)
+		else:
+			newMetadata.remove(collection, fileName)
+
 	for collection, collDir, fileList in filesToDownloadList:
-		if collDir != '' and not os.path.exists(os.path.join(localLibraryPath, collDir)):
-			print("Creating directory for '" + collDir + "'")
-			os.makedirs(os.path.join(localLibraryPath, collDir))
 		for fileName in fileList:
-			try:
-				partUrl = collDir + "/" + fileName
-				downloaded = getRemoteFile(partUrl)
-				with open(os.path.join(localLibraryPath, collDir, fileName), 'wb') as local_file:
-					local_file.write(downloaded.read())
-			except Exception as exp:
-				print >> sys.stderr, ("Could download %s file: %s" % (partUrl, str(exp)))
-				print >> sys.stderr, ("Omitting.")
-				# remove entry about file in order to download it later
-				newMetadata.remove_option(collection, fileName)
-		if len(newMetadata.options(collection)) == 0:
-			newMetadata.remove_section(collection)
+			entry = newMetadata.get(collection, fileName)
+			if entry is not None and entry[2] is not None:
+				contentIndex.add(os.path.join(localLibraryPath, collDir, fileName), entry[2])
+	try:
+		contentIndex.save()
+	except IOError as exp:
+		print >> sys.stderr, ("Could not save content index: " + str(exp))
 
 	# replace local metadata with new one
 	try:
-		with open(os.path.join(localLibraryPath, metadataFileName), 'w') as file:
-			newMetadata.write(file)
+		saveMetadata(newMetadata, os.path.join(localLibraryPath, metadataFileName))
 	except IOError as exp:
 		print >> sys.stderr, ("Could not write updated metadata file: " + str(exp))
 		sys.exit(1)
 
 # generate collection - combine data from config file and directory tree
-collectionsList = lambda metadata: [sec.decode('utf-8') for sec in metadata.sections() if not re.match(r'___\w+___', sec)]
+collectionsList = lambda metadata: [name.decode('utf-8') for name in metadata.collectionNames()]
 
-if not args.generate:
-	newCollections = getCollections(collectionsList(newMetadata))
-else:
-	newCollections = getCollections(collectionsList(oldMetadata))
+with profile.phase('collections_scan'):
+	if not args.generate:
+		newCollections = getCollections(collectionsList(newMetadata), snapshot)
+	else:
+		newCollections = getCollections(collectionsList(oldMetadata), snapshot)
+
+try:
+	snapshot.save()
+except IOError as exp:
+	print >> sys.stderr, ("Could not save directory snapshot: " + str(exp))
 
 print("Collections from directory structure:")
 printCollections(newCollections)
@@ -359,12 +1253,35 @@ preserveExistingCollections = CONF('preserve_existing_collections')
 if preserveExistingCollections:
 	print("Preserving existing collections.")
 
+hashCache = HashCache(hashCacheFilePath)
+
+collectionsState = {}
+if not args.full_rescan:
+	try:
+		with open(collectionsStateFilePath) as fp:
+			collectionsState = json.load(fp)
+	except (IOError, ValueError):
+		pass
+
 try:
-	jsonChanged = saveToJsonFile(newCollections, preserveExistingCollections)
+	with profile.phase('collections_json'):
+		jsonChanged = saveToJsonFile(newCollections, preserveExistingCollections, hashCache, collectionsState, updatedPaths if not args.generate else frozenset())
 except IOError:
 	print("Error by writing 'collections.json' file. Aborting.")
 	sys.exit(1)
 
+try:
+	with open(collectionsStateFilePath + '.tmp', 'w') as fp:
+		json.dump(collectionsState, fp)
+	os.rename(collectionsStateFilePath + '.tmp', collectionsStateFilePath)
+except IOError as exp:
+	print >> sys.stderr, ("Could not save collections state: " + str(exp))
+
+try:
+	hashCache.save()
+except IOError as exp:
+	print >> sys.stderr, ("Could not save hash cache: " + str(exp))
+
 print("")
 if jsonChanged:
 	print("Collections file saved.")
@@ -379,4 +1296,5 @@ if (checkRebootFlag(oldMetadata, newMetadata) or args.generate) and not args.no_
 else:
 	# call library refreshing
 	print("Refreshing library.")
-	subprocess.call("dbus-send --system /default com.lab126.powerd.resuming int32:1".split())
+	if not DEVEL:
+		subprocess.call("dbus-send --system /default com.lab126.powerd.resuming int32:1".split())
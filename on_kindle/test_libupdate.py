@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of libupdate.py run against the stand-in server of benchmark.py. libupdate.py is run by the Python 2.7
+interpreter given by MAILBOOK_PYTHON, python2.7 by default; the tests are skipped if it's not available.
+
+$ MAILBOOK_PYTHON=/usr/bin/python2.7 python3 -m unittest discover on_kindle
+
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import unittest
+
+import benchmark
+
+python = os.environ.get('MAILBOOK_PYTHON', 'python2.7')
+
+def pythonAvailable():
+	try:
+		return subprocess.call([python, '-c', 'import ConfigParser'], stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL) == 0
+	except OSError:
+		return False
+
+@unittest.skipUnless(pythonAvailable(), "Python 2.7 interpreter not available, set MAILBOOK_PYTHON")
+class LibupdateTest(unittest.TestCase):
+
+	def setUp(self):
+		self.args = argparse.Namespace(files = 30, collections = 3, sizes = '2k', compressible = 0.5, parallel_downloads = 2,
+			python = python, seed = 1)
+		self.workDir = tempfile.mkdtemp('mailbook-test')
+		self.libraryPath = os.path.join(self.workDir, 'server', 'library')
+		os.makedirs(self.libraryPath)
+
+		self.server = benchmark.StandInServer(os.path.join(self.workDir, 'server'), 0, 0)
+		threading.Thread(target = self.server.serve_forever, daemon = True).start()
+
+		benchmark.generateLibrary(self.libraryPath, self.args)
+		self.userDirectory = benchmark.makeUserDirectory(self.workDir, self.server.server_address, self.args)
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		shutil.rmtree(self.workDir)
+
+	def publishNews(self, count):
+		"""Publishes the books one by one, each in its own transaction, as extract.py does for the separate messages."""
+		rnd = random.Random(self.args.seed)
+		for i in range(count):
+			benchmark.publishBooks(self.libraryPath, [('News', 'news_%d.mobi' % i, 2048)], rnd, self.args)
+
+	def setCompaction(self, ratio, historyLength = None):
+		"""Makes FILELIST.jsonl rewritten less often, so it's behind the change log."""
+		for name in ('compactRatio', 'historyLength'):
+			self.addCleanup(setattr, benchmark.filelist, name, getattr(benchmark.filelist, name))
+		benchmark.filelist.compactRatio = ratio
+		if historyLength is not None:
+			benchmark.filelist.historyLength = historyLength
+
+	def cutLog(self):
+		"""Leaves only the last transaction in the log, as the older versions of the server could."""
+		changesPath = os.path.join(self.libraryPath, 'FILELIST' + benchmark.filelist.changesSuffix)
+		with open(changesPath) as f:
+			lines = f.readlines()
+		with open(changesPath, 'w') as f:
+			f.writelines(lines[-1:])
+
+	def runUpdate(self):
+		result = benchmark.runUpdate(self.userDirectory, self.server, [], self.args)
+		newsDirectory = os.path.join(self.userDirectory, 'documents', 'news')
+		return (result, sorted(os.listdir(newsDirectory)) if os.path.isdir(newsDirectory) else [])
+
+	def readHashCache(self):
+		with open(os.path.join(self.userDirectory, 'system', 'mailbook-hashes.json')) as f:
+			return json.load(f)
+
+	def testHashCacheSurvivesNoopUpdate(self):
+		benchmark.runUpdate(self.userDirectory, self.server, [], self.args)
+		entries = self.readHashCache()
+		self.assertEqual(len(entries), self.args.files)
+
+		# nothing changed, so no collection is rehashed and the cache mustn't be pruned
+		result = benchmark.runUpdate(self.userDirectory, self.server, [], self.args)
+		self.assertEqual(result['counters'].get('files_hashed', 0), 0)
+		self.assertEqual(self.readHashCache(), entries)
+
+	def testNoopUpdateUsesSnapshot(self):
+		benchmark.runUpdate(self.userDirectory, self.server, [], self.args)
+		benchmark.waitForSnapshot()
+		# the directories written by the full update are listed again once, because of the FAT mtime resolution
+		result = benchmark.runUpdate(self.userDirectory, self.server, [], self.args)
+		self.assertEqual(result['counters'].get('directories_from_snapshot', 0), 0)
+
+		# only the documents directory is listed, the local FILELIST copy in it is written by each run
+		result = benchmark.runUpdate(self.userDirectory, self.server, [], self.args)
+		self.assertEqual(result['counters'].get('directories_from_snapshot'), self.args.collections)
+		self.assertEqual(result['counters'].get('files_scanned', 0), 0)
+
+	def testRequestsGoThroughProxy(self):
+		result = benchmark.runUpdate(self.userDirectory, self.server, [], self.args)
+		self.assertGreater(result['server']['requests'], self.args.files)
+		self.assertEqual(result['server'].get('proxy_requests'), result['server']['requests'])
+
+	def testNewDeviceGetsBooksAfterSnapshot(self):
+		# FILELIST.jsonl is rewritten less often than the log is cut
+		self.setCompaction(1.0, 2)
+		self.publishNews(12)
+
+		result, news = self.runUpdate()
+		self.assertEqual(news, sorted('news_%d.mobi' % i for i in range(12)))
+
+	def testJournalIsReadWhenLogIsCut(self):
+		self.setCompaction(100)
+		self.publishNews(3)
+		# the full file is behind the log cut by the older version of the server
+		self.cutLog()
+
+		result, news = self.runUpdate()
+		self.assertEqual(news, ['news_0.mobi', 'news_1.mobi', 'news_2.mobi'])
+
+		# the next books come from the log again
+		self.publishNews(5)
+		result, news = self.runUpdate()
+		self.assertEqual(len(news), 5)
+
+	def testMissingHistoryFailsTheRun(self):
+		self.setCompaction(100)
+		self.publishNews(3)
+		self.cutLog()
+		os.remove(os.path.join(self.libraryPath, 'FILELIST' + benchmark.filelist.journalSuffix))
+
+		# the stale metadata mustn't be saved as the current one
+		with self.assertRaises(RuntimeError):
+			benchmark.runUpdate(self.userDirectory, self.server, [], self.args)
+		self.assertFalse(os.path.exists(os.path.join(self.userDirectory, 'system', 'mailbook-FILELIST')))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the extract.py pipeline: checkAndGetAttachments -> convertAttachments -> updateFilelist.
+
+Generates synthetic Maildir with the given mix of messages and attachments, runs the pipeline against it
+with the fake converter instead of ebook-convert and reports messages per second, peak RSS and the time
+of each stage. The results are saved as JSON, so the runs of different versions can be compared.
+
+(C) 2013 Michał Słomkowski
+https://github.com/slomkowski/mailbook
+
+"""
+
+import argparse
+import configparser
+import contextlib
+import json
+import mailbox
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from email.message import EmailMessage
+
+from benchmarking import parseSize, printComparison
+
+validSender = 'reader@example.com'
+
+def fakeConvert(sourcePath, destinationPath, delay):
+	"""Stands in for ebook-convert: waits and writes the output of the similar size."""
+	time.sleep(delay)
+	shutil.copyfile(sourcePath, destinationPath)
+
+def generateMaildir(path, args):
+	"""Creates the Maildir with args.messages messages. Returns the number of messages which should be accepted."""
+	rnd = random.Random(args.seed)
+	sizes = [parseSize(size) for size in args.sizes.split(',')]
+	formats = args.formats.split(',')
+	collections = ['Collection %d' % i for i in range(args.collections)]
+
+	mb = mailbox.Maildir(path, create = True)
+	noValid = 0
+	for i in range(args.messages):
+		validFrom = rnd.random() >= args.invalid_sender_ratio
+		validSubject = rnd.random() >= args.invalid_subject_ratio
+
+		msg = EmailMessage()
+		msg['From'] = 'Reader <%s>' % (validSender if validFrom else 'spammer%d@example.org' % i)
+		if validSubject:
+			msg['Subject'] = 'kindle: ' + rnd.choice(collections) if len(collections) > 0 else 'kindle'
+		else:
+			msg['Subject'] = 'Offer number %d' % i
+		msg.set_content("Sent by mailbook benchmark.\n")
+
+		for j in range(args.attachments):
+			extension = rnd.choice(formats)
+			msg.add_attachment(rnd.randbytes(rnd.choice(sizes)), maintype = 'application', subtype = 'octet-stream',
+				filename = 'book_%d_%d.%s' % (i, j, extension))
+		mb.add(msg)
+
+		if validFrom and validSubject:
+			noValid += 1
+	mb.close()
+	return noValid
+
+def makeConfig(args, workDir):
+	config = configparser.ConfigParser(interpolation = None)
+	config['DEFAULT'] = {
+		'mailbox_path' : os.path.join(workDir, 'Maildir'),
+		'output_directory' : os.path.join(workDir, 'library'),
+		'check_senders' : '1',
+		'valid_senders' : validSender,
+		'max_attachment_size' : str(args.max_attachment_size),
+		'spool_directory' : os.path.join(workDir, 'spool'),
+		'queue_file' : os.path.join(workDir, 'queue.sqlite'),
+		}
+	config['mobi_converter'] = {
+		'backend' : 'command',
+		'command' : '%s %s --fake-convert @@OLD_NAME@@ @@NEW_NAME@@ %f' % (sys.executable, os.path.realpath(__file__), args.convert_delay),
+		'values_success' : '0',
+		'output_file' : 'lambda filePath: filePath',
+		'jobs' : str(args.jobs),
+		}
+	config['compression'] = {
+		'gzip' : '1' if args.min_saving >= 0 else '0',
+		'min_saving' : str(args.min_saving),
+		}
+	return config
+
+def runPipeline(args, workDir, results):
+	"""Runs in the separate process, so its peak RSS doesn't include the generator."""
+	import extract
+
+	extract.setup(makeConfig(args, workDir))
+	os.makedirs(extract.config['DEFAULT']['output_directory'])
+
+	maxSize = int(args.max_attachment_size * 1024 * 1024)
+
+	stages = {}
+	start = time.monotonic()
+	with open(os.devnull, 'w') as devNull, contextlib.redirect_stdout(devNull):
+		t = time.monotonic()
+		noFiles, rebootFlag, collWithAttachments, moreLeft = extract.checkAndGetAttachments(extract.config['DEFAULT']['mailbox_path'],
+			extract.spoolRoot, extract.validSenders, None, maxSize)
+		stages['checkAndGetAttachments'] = time.monotonic() - t
+
+		t = time.monotonic()
+		changes = [(collectionName, changeList) for collectionName, changeList in extract.convertAttachments(collWithAttachments) if len(changeList) > 0]
+		stages['convertAttachments'] = time.monotonic() - t
+
+		t = time.monotonic()
+		if len(changes) > 0:
+			extract.updateFilelist(changes, rebootFlag)
+		stages['updateFilelist'] = time.monotonic() - t
+	overall = time.monotonic() - start
+
+	snapshot = json.loads(extract.stats.toJson())
+	results.put({
+		'seconds' : overall,
+		'messages_per_second' : args.messages / overall if overall > 0 else None,
+		'files' : noFiles,
+		'files_published' : sum(len(changeList) for collectionName, changeList in changes),
+		# kilobytes on Linux
+		'peak_rss_kb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+		'stages' : stages,
+		'detailed_stages' : snapshot['stages'],
+		'counters' : snapshot['counters'],
+		})
+
+def compareResults(old, new):
+	"""Prints the changes between two result files."""
+	rows = [(key, old['result'].get(key), new['result'].get(key)) for key in ('seconds', 'messages_per_second', 'peak_rss_kb')]
+	rows += [(stage, old['result']['stages'].get(stage), new['result']['stages'][stage]) for stage in sorted(new['result']['stages'])]
+	printComparison(rows)
+
+def parseCommandLineArgs():
+	parser = argparse.ArgumentParser(description = "Benchmark of the mailbook extract.py pipeline.")
+	parser.add_argument("-m", "--messages", type = int, default = 100, help = "number of messages in the mailbox")
+	parser.add_argument("-a", "--attachments", type = int, default = 1, help = "attachments per message")
+	parser.add_argument("-s", "--sizes", default = "100k,1M", help = "comma separated attachment sizes to choose from, e.g. 10k,1M,80M")
+	parser.add_argument("-f", "--formats", default = "epub,pdf,mobi", help = "comma separated attachment extensions to choose from")
+	parser.add_argument("-c", "--collections", type = int, default = 3, help = "number of collections in the subjects")
+	parser.add_argument("--invalid-sender-ratio", type = float, default = 0.1, help = "part of messages from unknown senders")
+	parser.add_argument("--invalid-subject-ratio", type = float, default = 0.1, help = "part of messages with not matching subject")
+	parser.add_argument("--max-attachment-size", type = float, default = 0, help = "attachment size limit in megabytes, 0 means no limit")
+	parser.add_argument("-j", "--jobs", type = int, default = os.cpu_count() or 1, help = "number of conversions at the same time")
+	parser.add_argument("--min-saving", type = float, default = 0.1, help = "minimal saving of the compressed variants, negative disables them")
+	parser.add_argument("--convert-delay", type = float, default = 0.05, help = "seconds taken by the fake converter")
+	parser.add_argument("--seed", type = int, default = 1)
+	parser.add_argument("--keep", action = 'store_true', help = "don't remove the working directory")
+	parser.add_argument("-o", "--output", help = "save the results to this JSON file")
+	parser.add_argument("--compare", nargs = 2, metavar = ("OLD", "NEW"), help = "compare two result files and exit")
+	parser.add_argument("--fake-convert", nargs = 3, metavar = ("SOURCE", "DESTINATION", "DELAY"), help = argparse.SUPPRESS)
+	return parser.parse_args()
+
+if __name__ == '__main__':
+	args = parseCommandLineArgs()
+
+	if args.fake_convert:
+		fakeConvert(args.fake_convert[0], args.fake_convert[1], float(args.fake_convert[2]))
+		sys.exit(0)
+
+	if args.compare:
+		with open(args.compare[0]) as old, open(args.compare[1]) as new:
+			compareResults(json.load(old), json.load(new))
+		sys.exit(0)
+
+	workDir = tempfile.mkdtemp('mailbook-benchmark')
+	try:
+		print("Generating %d messages in %s ..." % (args.messages, workDir))
+		noValid = generateMaildir(os.path.join(workDir, 'Maildir'), args)
+
+		print("Running the pipeline ...")
+		context = multiprocessing.get_context('spawn')
+		results = context.Queue()
+		process = context.Process(target = runPipeline, args = (args, workDir, results))
+		process.start()
+		result = results.get()
+		process.join()
+	finally:
+		if not args.keep:
+			shutil.rmtree(workDir)
+
+	import extract
+
+	report = {
+		'version' : extract.__version__,
+		'timestamp' : time.strftime("%Y-%m-%d_%H:%M:%S", time.localtime()),
+		'parameters' : dict((key, value) for key, value in vars(args).items() if key not in ('output', 'compare', 'fake_convert', 'keep')),
+		'accepted_messages' : noValid,
+		'result' : result,
+		}
+
+	print(json.dumps(report, indent = 1, sort_keys = True))
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(report, f, indent = 1, sort_keys = True)
+		print("Results saved to " + args.output)
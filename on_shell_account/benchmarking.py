@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers shared by the benchmarks of extract.py (on_shell_account/benchmark.py) and libupdate.py
+(on_kindle/benchmark.py).
+
+(C) 2013 Michał Słomkowski
+https://github.com/slomkowski/mailbook
+
+"""
+
+def parseSize(text):
+	"""Converts the size like 100, 10k or 1.5M to the number of bytes."""
+	text = text.strip().lower()
+	multipliers = {'k' : 1024, 'm' : 1024 * 1024}
+	if text[-1] in multipliers:
+		return int(float(text[:-1]) * multipliers[text[-1]])
+	return int(text)
+
+def printComparison(rows):
+	"""Prints the table of the changes. rows is the list of tuples (name, old value, new value), the rows
+	with a missing or zero old value are left out.
+	"""
+	print("%-32s %12s %12s %9s" % ("", "old", "new", "change"))
+	for name, oldValue, newValue in rows:
+		if oldValue and newValue is not None:
+			print("%-32s %12.4f %12.4f %+8.1f%%" % (name, oldValue, newValue, (newValue - oldValue) * 100.0 / oldValue))
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Compressed transfer variants of the library files, used by extract.py and kindle.py.
+
+FILELIST records which books have the variant and libupdate.py on Kindle asks for '<file>.gz' only for them,
+so the variant of the book is kept only when it saves enough bytes. The variant left from the older version of the file has to be removed
+before the new version is published, otherwise Kindle would download the old content. Only gzip is written,
+because Python 2.7 on Kindle has no lzma module.
+
+(C) 2013 Michał Słomkowski
+https://github.com/slomkowski/mailbook
+
+"""
+
+import gzip
+import os
+import shutil
+
+suffix = '.gz'
+
+def variantPath(path):
+	return path + suffix
+
+def removeVariant(path):
+	try:
+		os.remove(variantPath(path))
+	except FileNotFoundError:
+		pass
+
+def writeVariant(path, minSaving = None, level = 9):
+	"""Writes the gzip variant next to the file. If minSaving is given, the variant is kept only if it's smaller
+	by at least this part of the original size. Returns the number of bytes saved, 0 if the variant was not kept.
+	"""
+	tempPath = variantPath(path) + '.tmp'
+	with open(path, 'rb') as source, open(tempPath, 'wb') as raw:
+		# no file name and time in the header, so the same content gives the same variant
+		with gzip.GzipFile(filename = '', mode = 'wb', compresslevel = level, fileobj = raw, mtime = 0) as compressed:
+			shutil.copyfileobj(source, compressed, 1024 * 1024)
+
+	originalSize = os.path.getsize(path)
+	saved = originalSize - os.path.getsize(tempPath)
+	if minSaving is not None and saved < minSaving * originalSize:
+		os.remove(tempPath)
+		removeVariant(path)
+		return 0
+
+	os.replace(tempPath, variantPath(path))
+	return max(saved, 0)
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Converter backends used by extract.py and kindle.py to make .mobi files.
+
+The backend is selected by the 'backend' option of the converter configuration:
+* command - runs the command template (kindlegen, ebook-convert) for each file,
+* worker - keeps a pool of long-lived converterworker.py processes, so the converter is loaded only once.
+
+Success codes, output file naming and timeouts are handled here for all backends.
+
+(C) 2013 Michał Słomkowski
+https://github.com/slomkowski/mailbook
+
+"""
+
+import abc
+import json
+import os
+import queue
+import select
+import shutil
+import subprocess
+import threading
+
+workerScript = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'converterworker.py')
+
+backends = {}
+
+class ConversionTimeout(Exception):
+	pass
+
+def register(name):
+	"""Class decorator which adds the backend to the registry."""
+	def decorator(backendClass):
+		backendClass.name = name
+		backends[name] = backendClass
+		return backendClass
+	return decorator
+
+def create(options):
+	"""Creates the backend from the converter options. The options can be dict or ConfigParser section."""
+	name = options.get('backend', 'command')
+	try:
+		backendClass = backends[name]
+	except KeyError:
+		raise ValueError("Unknown converter backend: " + name)
+	return backendClass(options)
+
+def getSuccessValues(options):
+	values = options.get('values_success', '0')
+	if isinstance(values, str):
+		values = [int(val.strip()) for val in values.split(';')]
+	return tuple(values)
+
+def getOutputNaming(options):
+	"""Returns the function which turns the output file path into the form expected by the converter.
+	In the configuration file it's given as the text of lambda expression.
+	"""
+	naming = options.get('output_file', None)
+	if naming is None:
+		return lambda filePath: filePath
+	if isinstance(naming, str):
+		return eval(naming, {'os' : os})
+	return naming
+
+def getTimeout(options):
+	timeout = float(options.get('timeout', 0) or 0)
+	return timeout or None
+
+class Converter(abc.ABC):
+	"""Base class of the backends."""
+
+	def __init__(self, options):
+		self.valuesSuccess = getSuccessValues(options)
+		self.outputNaming = getOutputNaming(options)
+		self.timeout = getTimeout(options)
+
+	@abc.abstractmethod
+	def identity(self):
+		"""Returns the text describing the converter and its settings. Same input and identity give the same output."""
+
+	@abc.abstractmethod
+	def run(self, sourcePath, outputName):
+		"""Performs the conversion, returns the exit code of the converter."""
+
+	def convert(self, sourcePath, destinationPath):
+		"""Converts the file and returns True on success. Raises ConversionTimeout if the converter took too long."""
+		ret = self.run(sourcePath, self.outputNaming(destinationPath))
+		if ret not in self.valuesSuccess:
+			return False
+
+		# converters taking only base name (kindlegen) put the output next to the source file
+		if not os.path.exists(destinationPath):
+			besideSource = os.path.join(os.path.dirname(sourcePath), os.path.basename(destinationPath))
+			if not os.path.exists(besideSource):
+				return False
+			shutil.move(besideSource, destinationPath)
+		return True
+
+	def close(self):
+		pass
+
+@register('command')
+class CommandConverter(Converter):
+	"""Runs the command template for each file. @@OLD_NAME@@ and @@NEW_NAME@@ are replaced by the file names."""
+
+	def __init__(self, options):
+		Converter.__init__(self, options)
+		self.command = options['command']
+		self.quiet = str(options.get('quiet', '0')).lower() in ('1', 'true', 'yes')
+
+	def identity(self):
+		return self.command
+
+	def run(self, sourcePath, outputName):
+		command = [part.replace('@@OLD_NAME@@', sourcePath).replace('@@NEW_NAME@@', outputName) for part in self.command.split()]
+		with open(os.devnull, "w") as devNull:
+			try:
+				return subprocess.call(command, stdout = devNull, stderr = devNull if self.quiet else None, timeout = self.timeout)
+			except subprocess.TimeoutExpired:
+				raise ConversionTimeout(sourcePath)
+
+class Worker:
+	"""Single converterworker.py process. Requests and responses are JSON lines on its stdin and stdout."""
+
+	def __init__(self, command, quiet):
+		self.jobsDone = 0
+		with open(os.devnull, "w") as devNull:
+			self.process = subprocess.Popen(command, stdin = subprocess.PIPE, stdout = subprocess.PIPE,
+				stderr = devNull if quiet else None)
+
+	def request(self, sourcePath, outputName, timeout):
+		self.process.stdin.write((json.dumps({'source' : sourcePath, 'destination' : outputName}) + "\n").encode('utf-8'))
+		self.process.stdin.flush()
+
+		readable, _, _ = select.select([self.process.stdout], [], [], timeout)
+		if not readable:
+			raise ConversionTimeout(sourcePath)
+
+		line = self.process.stdout.readline()
+		if not line:
+			raise OSError("Conversion worker exited unexpectedly.")
+		self.jobsDone += 1
+		return json.loads(line.decode('utf-8'))['code']
+
+	def close(self):
+		if self.process.poll() is None:
+			self.process.kill()
+			self.process.wait()
+
+@register('worker')
+class WorkerPoolConverter(Converter):
+	"""Keeps up to 'workers' converter processes running. Each one is replaced after 'max_jobs_per_worker' conversions,
+	after a timeout or when it dies.
+	"""
+
+	def __init__(self, options):
+		Converter.__init__(self, options)
+		self.command = [part.replace('@@WORKER@@', workerScript) for part in options.get('worker_command', 'calibre-debug -e @@WORKER@@').split()]
+		self.size = max(1, int(options.get('workers', 0) or options.get('jobs', 0) or os.cpu_count() or 1))
+		self.maxJobs = int(options.get('max_jobs_per_worker', 50))
+		self.quiet = str(options.get('quiet', '0')).lower() in ('1', 'true', 'yes')
+		self.idle = queue.Queue()
+		self.running = 0
+		self.lock = threading.Lock()
+
+	def identity(self):
+		return 'worker:' + ' '.join(self.command)
+
+	def acquire(self):
+		while True:
+			try:
+				return self.idle.get_nowait()
+			except queue.Empty:
+				pass
+			with self.lock:
+				if self.running < self.size:
+					self.running += 1
+					break
+			# all workers are busy, wait until one of them is released or replaced
+			try:
+				return self.idle.get(timeout = 1)
+			except queue.Empty:
+				pass
+
+		try:
+			return Worker(self.command, self.quiet)
+		except OSError:
+			with self.lock:
+				self.running -= 1
+			raise
+
+	def release(self, worker, healthy):
+		if healthy and worker.jobsDone < self.maxJobs:
+			self.idle.put(worker)
+			return
+		worker.close()
+		with self.lock:
+			self.running -= 1
+
+	def run(self, sourcePath, outputName):
+		worker = self.acquire()
+		healthy = False
+		try:
+			ret = worker.request(sourcePath, outputName, self.timeout)
+			healthy = True
+			return ret
+		finally:
+			self.release(worker, healthy)
+
+	def close(self):
+		while True:
+			try:
+				self.idle.get_nowait().close()
+			except queue.Empty:
+				break
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Long-lived conversion worker used by the 'worker' converter backend. It has to be run by the Python interpreter
+of the converter, so the converter code is imported only once, e.g.:
+
+calibre-debug -e converterworker.py
+
+Reads the requests {"source": ..., "destination": ...} from stdin, one JSON object per line, and answers each of them
+with {"code": exit code} line on stdout. The entry point of the converter can be given as the argument 'module:function',
+the function is called like main() of the command line tool.
+
+(C) 2013 Michał Słomkowski
+https://github.com/slomkowski/mailbook
+
+"""
+
+import importlib
+import json
+import os
+import sys
+import traceback
+
+defaultEntryPoint = 'calibre.ebooks.conversion.cli:main'
+
+def loadEntryPoint(entryPoint):
+	moduleName, functionName = entryPoint.split(':')
+	return getattr(importlib.import_module(moduleName), functionName)
+
+def main():
+	convert = loadEntryPoint(sys.argv[1] if len(sys.argv) > 1 else defaultEntryPoint)
+
+	# the converter writes its messages to stdout, so the protocol gets its own copy of it and stdout goes to stderr
+	protocol = os.fdopen(os.dup(1), 'w')
+	os.dup2(2, 1)
+
+	for line in sys.stdin:
+		request = json.loads(line)
+		try:
+			code = convert(['ebook-convert', request['source'], request['destination']]) or 0
+		except SystemExit as exp:
+			code = exp.code if isinstance(exp.code, int) else (0 if exp.code is None else 1)
+		except Exception:
+			traceback.print_exc()
+			code = -1
+
+		sys.stdout.flush()
+		protocol.write(json.dumps({'code' : code}) + "\n")
+		protocol.flush()
+
+if __name__ == '__main__':
+	main()
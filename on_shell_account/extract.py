@@ -44,13 +44,25 @@ import unicodedata
 import os
 import configparser
 import time
-import subprocess
 import shutil
-import tempfile
+import concurrent.futures
 import fcntl
-import signal
+import select
+import ctypes
+import ctypes.util
 import sys
 import email.header
+import email.parser
+import email.utils
+import binascii
+import hashlib
+import threading
+
+import compression
+import converters
+import filelist
+import jobqueue
+import metrics
 
 def convertToFileName(originalFileName):
 	"""Removes spaces and special characters from the file name."""
@@ -86,59 +98,256 @@ def getConfiguration(configFile = None):
 
 	return conf
 
-def extractAttachments(message):
-	"""Takes Message instance and returns the list of tuples (fileName, newName, fileData, performConversion)
+def getAttachmentInfo(headers):
+	"""Takes the headers of the MIME part and returns the tuple (fileName, newName, performConversion) if the part
+	is an attachment which should be added to the library. Otherwise returns None.
+	"""
+	cd = headers.get('Content-Disposition', None)
+	if cd is None:
+		return None
+
+	disps = [elem.strip() for elem in cd.split(';')]
+	if disps[0].lower() != 'attachment':
+		return None
+
+	fileName = ""
+
+	# acquire file name
+	for param in disps[1:]:
+		(name, value) = param.split("=", 1)
+		# file name can be made of several parts, each limited to 40 characters (Opera mail client behavior)
+		if re.search("name", name, re.I):
+			fileName += value
+
+	# if failed to find a file name
+	if fileName == "":
+		print("Warning! Failed to find a file name for attachment!")
+		return None
+
+	fileName = convertToFileName(fileName)
+
+	for extension in supportedFormats:
+		if re.search(r'\.' + extension + r'$', fileName):
+			performConversion = supportedFormats[extension]
+			newName = fileName
+			if performConversion:
+				newName = re.sub(r'\.' + extension + r'$', '.mobi', fileName)
+			return (fileName, newName, performConversion)
+
+	print("Warning! File " + fileName + " not added.")
+	return None
+
+class AttachmentWriter:
+	"""Decodes the body of the MIME part line by line and writes it to the spool file. Only the current line
+	is kept in memory. Base64 and quoted-printable are decoded, other encodings are written as they are.
+	"""
+
+	def __init__(self, path, encoding, maxSize = 0):
+		self.path = path
+		self.encoding = encoding
+		self.maxSize = maxSize
+		self.size = 0
+		self.tooLarge = False
+		# the line break before the boundary belongs to the boundary, so it's written only when the next line comes
+		self.pendingEol = b''
+		self.base64Rest = b''
+		self.file = open(path, 'wb')
+
+	def feed(self, line):
+		if self.tooLarge:
+			return
+
+		if self.encoding == 'base64':
+			data = self.base64Rest + b''.join(line.split())
+			usable = len(data) - len(data) % 4
+			self.base64Rest = data[usable:]
+			self.write(binascii.a2b_base64(data[:usable]))
+			return
+
+		content = line.rstrip(b'\r\n')
+		eol = line[len(content):]
+		if self.encoding == 'quoted-printable':
+			if content.endswith(b'='):
+				# soft line break
+				content, eol = binascii.a2b_qp(content[:-1]), b''
+			else:
+				# the line break is kept as it is in the message, the same as the email package does
+				content = binascii.a2b_qp(content)
+
+		self.write(self.pendingEol + content)
+		self.pendingEol = eol
+
+	def write(self, data):
+		self.size += len(data)
+		if self.maxSize and self.size > self.maxSize:
+			self.tooLarge = True
+			return
+		self.file.write(data)
+
+	def close(self):
+		"""Closes the spool file. Returns False and removes the file if it exceeded the size limit."""
+		if self.base64Rest and not self.tooLarge:
+			try:
+				self.write(binascii.a2b_base64(self.base64Rest + b'=' * (-len(self.base64Rest) % 4)))
+			except binascii.Error:
+				pass
+		self.file.close()
+
+		if self.tooLarge:
+			os.remove(self.path)
+			return False
+		return True
+
+def readLines(fp, maxLength = 64 * 1024):
+	"""Yields the lines of the binary file. Very long lines are split into chunks of maxLength bytes."""
+	return iter(lambda: fp.readline(maxLength), b'')
+
+def readHeaders(lines):
+	"""Reads the lines until the empty line and returns Message instance containing only headers."""
+	headerLines = []
+	for line in lines:
+		if line.rstrip(b'\r\n') == b'':
+			break
+		headerLines.append(line)
+	return email.parser.BytesHeaderParser().parsebytes(b''.join(headerLines))
+
+def matchBoundary(line, boundaries):
+	"""Returns the tuple (boundary, isClosing) if the line is the delimiter of one of the multiparts. Otherwise returns None."""
+	if not line.startswith(b'--'):
+		return None
+	stripped = line.rstrip()
+	for boundary in reversed(boundaries):
+		if stripped == b'--' + boundary:
+			return (boundary, False)
+		if stripped == b'--' + boundary + b'--':
+			return (boundary, True)
+	return None
+
+def skipToBoundary(lines, boundaries):
+	for line in lines:
+		delimiter = matchBoundary(line, boundaries)
+		if delimiter:
+			return delimiter
+	return None
+
+def streamParts(lines, headers, boundaries, messageDir, maxSize, attachments):
+	"""Walks the body of the MIME part described by headers. The attachments are decoded directly to the files
+	in messageDir and the tuples (fileName, newName, spoolPath, performConversion) are appended to attachments.
+	Returns the delimiter which ended the part or None at the end of file.
+	"""
+	boundary = headers.get_param('boundary') if headers.get_content_maintype() == 'multipart' else None
+
+	if boundary is not None:
+		boundary = email.utils.collapse_rfc2231_value(boundary).encode('ascii', 'ignore')
+		innerBoundaries = boundaries + [boundary]
+		# preamble
+		delimiter = skipToBoundary(lines, innerBoundaries)
+		while delimiter == (boundary, False):
+			delimiter = streamParts(lines, readHeaders(lines), innerBoundaries, messageDir, maxSize, attachments)
+		if delimiter == (boundary, True):
+			# epilogue
+			delimiter = skipToBoundary(lines, boundaries)
+		return delimiter
+
+	info = getAttachmentInfo(headers)
+	writer = None
+	if info is not None:
+		encoding = headers.get('Content-Transfer-Encoding', '7bit').strip().lower()
+		# the index keeps the attachments with the same name apart
+		writer = AttachmentWriter(os.path.join(messageDir, "%d_%s" % (len(attachments), info[0])), encoding, maxSize)
+
+	delimiter = None
+	for line in lines:
+		delimiter = matchBoundary(line, boundaries)
+		if delimiter:
+			break
+		if writer:
+			writer.feed(line)
+
+	if writer:
+		(fileName, newName, performConversion) = info
+		if writer.close():
+			attachments.append((fileName, newName, writer.path, performConversion))
+		else:
+			print("Warning! File " + fileName + " exceeds the size limit. Omitting.")
+
+	return delimiter
+
+def extractAttachments(lines, headers, messageDir, maxSize = 0):
+	"""Takes the lines of the message body following the headers and writes the attachments to the spool directory.
+	Returns the list of tuples (fileName, newName, spoolPath, performConversion)
 	"""
 	attachments = []
-	for msgPart in message.walk():
-		cd = msgPart.get('Content-Disposition', None)
-		if cd is None:
-			continue
+	streamParts(lines, headers, [], messageDir, maxSize, attachments)
+	return attachments
 
-		disps = [elem.strip() for elem in cd.split(';')]
-		if disps[0].lower() != 'attachment':
-			continue
 
-		# get file content
-		fileData = msgPart.get_payload(decode = True)
-		fileName = ""
+def loadKeyIndex(indexPath):
+	"""Reads the set of message keys, one per line."""
+	try:
+		with open(indexPath, 'r') as f:
+			return set(line.strip() for line in f if line.strip())
+	except FileNotFoundError:
+		return set()
 
-		# acquire file name
-		for param in disps[1:]:
-			(name, value) = param.split("=")
-			# file name can be made of several parts, each limited to 40 characters (Opera mail client behavior)
-			if re.search("name", name, re.I):
-				fileName += value
+def saveKeyIndex(indexPath, keys):
+	tempPath = indexPath + '.tmp'
+	with open(tempPath, 'w') as f:
+		f.writelines(key + "\n" for key in sorted(keys))
+	os.replace(tempPath, indexPath)
 
-		# if failed to find a file name
-		if fileName is None:
-			print("Warning! Failed to find a file name for attachment!")
-			continue
+def checkHeaders(msg, validSenders = None):
+	"""Takes Message instance with the headers only. Returns the tuple (collectionName, rebootFlag)
+	if the message should be processed, None otherwise.
+	"""
+	validSubject = re.compile(r'^\s*(kindle)(?P<reboot_flag>-reboot)?(:\s*(?P<collection>[\w\d\- ]+))?\s*$', re.I)
+	emailFromHeader = re.compile(r'([\w\d\-\.]+@[\w\d\-\.]+)', re.I)
 
-		fileName = convertToFileName(fileName)
-		performConversion = False
-		addFile = False
-		newName = fileName
-
-		for extension in supportedFormats:
-			if re.search(r'\.' + extension + r'$', fileName):
-				addFile = True
-				performConversion = supportedFormats[extension]
-				if performConversion:
-					newName = re.sub(r'\.' + extension + r'$', '.mobi', fileName)
-				break
+	senderMatch = emailFromHeader.search(msg.get('From', ''))
+	sender = senderMatch.group(1) if senderMatch else ''
 
-		if addFile:
-			attachments.append((fileName, newName, fileData, performConversion))
-		else:
-			print("Warning! File " + fileName + " not added.")
+	content, encoding = email.header.decode_header(msg.get('Subject', ''))[0]
+	if isinstance(content, str):
+	     subject = content
+	else:
+	     subject = content.decode(encoding or 'ascii', 'replace')
 
-	return attachments
+	print("From: <" + sender + ">, Subject: '" + subject + "'")
+
+	if validSenders is not None and not sender in validSenders:
+		print("Invalid sender. Omitting.")
+		return None
 
+	names = validSubject.match(subject)
 
-def checkAndGetAttachments(mailboxPath, validSenders = None):
+	if not names:
+		print("Invalid subject. Omitting.")
+		return None
+
+	rebootFlag = False
+	if names.groupdict()['reboot_flag'] and names.groupdict()['collection']:
+		rebootFlag = True
+		print("Reboot flag updated.");
+
+	if names.groupdict()['collection']:
+		collectionName = names.groupdict()['collection'].strip()
+		print("Collection: " + collectionName)
+	else:
+		collectionName = ""
+
+	return (collectionName, rebootFlag)
+
+def checkAndGetAttachments(mailboxPath, spoolDir, validSenders = None, batchLimit = None, maxSize = 0, rejectedIndexPath = None, jobQueue = None):
 	"""Checks the mailbox for new deliveries and returns the collWithAttachments. Each email message is checked for proper subject
-	and if matches, the collWithAttachments are returned."""
+	and if matches, the collWithAttachments are returned. The attachments are written to spoolDir, only their paths are returned.
+	At most batchLimit messages are accepted in one pass, the last element of the returned tuple tells if there are some
+	messages left for the next pass.
+
+	Only the headers are read at first. The keys of rejected messages are remembered in the file rejectedIndexPath,
+	so they are not read again on the next pass.
+
+	If jobQueue is given, the attachments are added to it as the jobs and the messages stay in the mailbox
+	until the jobs are published. The messages already present in the queue are omitted."""
 
 	rebootFlag = False
 	noFiles = 0
@@ -146,171 +355,504 @@ def checkAndGetAttachments(mailboxPath, validSenders = None):
 	# initialize mailbox
 	mb = mailbox.Maildir(mailboxPath)
 
-	validSubject = re.compile(r'^\s*(kindle)(?P<reboot_flag>-reboot)?(:\s*(?P<collection>[\w\d\- ]+))?\s*$', re.I)
-	emailFromHeader = re.compile(r'([\w\d\-\.]+@[\w\d\-\.]+)', re.I)
+	rejectedKeys = loadKeyIndex(rejectedIndexPath) if rejectedIndexPath else set()
+	noRejected = len(rejectedKeys)
 
-	# get the messages with valid subject
-	collWithAttachments = []
-	for key in mb.keys():
-		msg = mb.get(key)
+	# Maildir keys begin with the delivery time, so the oldest messages go first
+	with stats.timer('mailbox_scan'):
+		keys = sorted(mb.keys())
 
-		sender = emailFromHeader.search(msg['From']).group(1)
+	# first phase - read only the headers of the messages not seen before
+	accepted = []
+	moreLeft = False
+	for key in keys:
+		if key in rejectedKeys or (jobQueue is not None and jobQueue.hasMessage(key)):
+			continue
 
-		content, encoding = email.header.decode_header(msg['Subject'])[0]
-		if isinstance(content, str):
-		     subject = content
-		else:
-		     subject = content.decode(encoding)
+		if batchLimit and len(accepted) >= batchLimit:
+			moreLeft = True
+			break
 
-		print("From: <" + sender + ">, Subject: '" + subject + "'")
+		with stats.timer('mime_parse'), mb.get_file(key) as messageFile:
+			result = checkHeaders(readHeaders(readLines(messageFile)), validSenders)
 
-		if validSenders is not None and not sender in validSenders:
-			print("Invalid sender. Omitting.")
+		if result is None:
+			stats.count('messages_rejected')
+			rejectedKeys.add(key)
 			continue
 
-		names = validSubject.match(subject)
+		stats.count('messages_accepted')
+		accepted.append((key, result[0], result[1]))
+		rebootFlag = rebootFlag or result[1]
 
-		if not names:
-			print("Invalid subject. Omitting.")
-			continue
+	# forget the messages which disappeared from the mailbox
+	rejectedKeys &= set(keys)
+	if rejectedIndexPath and (len(rejectedKeys) != noRejected or not os.path.exists(rejectedIndexPath)):
+		saveKeyIndex(rejectedIndexPath, rejectedKeys)
+
+	# second phase - decode the accepted messages
+	collWithAttachments = []
+	for index, (key, collectionName, messageRebootFlag) in enumerate(accepted):
+		# the message extracted again after a crash overwrites its old files
+		messageDir = os.path.join(spoolDir, key if jobQueue is not None else str(index))
+		os.makedirs(messageDir, exist_ok = True)
 
-		if names.groupdict()['reboot_flag'] and names.groupdict()['collection']:
-			rebootFlag = True
-			print("Reboot flag updated.");
+		with stats.timer('attachment_decode'), mb.get_file(key) as messageFile:
+			lines = readLines(messageFile)
+			attachments = extractAttachments(lines, readHeaders(lines), messageDir, maxSize)
 
-		if names.groupdict()['collection']:
-			collectionName = names.groupdict()['collection'].strip()
-			print("Collection: " + collectionName)
-		else:
-			collectionName = ""
+		stats.count('attachments_extracted', len(attachments))
+		stats.count('bytes_in', sum(os.path.getsize(spoolPath) for (name, newName, spoolPath, conversion) in attachments))
 
-		attachments = extractAttachments(msg)
 		if len(attachments) > 0:
 			collWithAttachments.append((collectionName, attachments))
 			noFiles += len(attachments)
+			if jobQueue is not None:
+				jobQueue.addMessage(key, collectionName, messageRebootFlag, attachments)
+				continue
+		elif jobQueue is not None:
+			shutil.rmtree(messageDir)
 		# remove the message from the mailbox
 		if not disableMailboxClearing:
 			mb.remove(key)
 
 	mb.close()
 
-	return (noFiles, rebootFlag, collWithAttachments)
-
+	return (noFiles, rebootFlag, collWithAttachments, moreLeft)
 
-def convertAttachments(collectionDirectory, attachments):
-	"""Takes the list of attachments, converts them and put in a collection directory."""
-	filesChanged = []
 
-	withColl = lambda fileName: collectionDirectory + "_" + fileName
-	collectionDir = os.path.join(config['DEFAULT']['output_directory'], collectionDirectory)
-
-	temporaryDir = tempfile.mkdtemp('kindle')
+def convertFile(sourcePath, destinationPath):
+	"""Runs the configured converter backend on a single file. Returns True if the converter reported success.
+	It's called from the worker threads, the real work is done by the converter process.
+	"""
+	start = time.monotonic()
+	try:
+		with stats.timer('conversion'):
+			success = converter.convert(sourcePath, destinationPath)
+	except converters.ConversionTimeout:
+		print("Conversion of " + os.path.basename(sourcePath) + " timed out.")
+		stats.count('conversions_timed_out')
+		return False
+	finally:
+		stats.observe('conversion_seconds', time.monotonic() - start)
+
+	stats.count('conversions_ok' if success else 'conversions_failed')
+	return success
+
+def linkOrCopy(sourcePath, destinationPath, hardLink = True):
+	"""Makes destinationPath a copy of sourcePath in the cheapest possible way: reflink, hard link or a plain copy.
+	Without hardLink the files never share the inode.
+	"""
+	FICLONE = 0x40049409
+	try:
+		with open(sourcePath, 'rb') as src, open(destinationPath, 'wb') as dst:
+			fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+		return
+	except OSError:
+		os.remove(destinationPath)
 
-	# create collection directory if needed
-	if not os.path.exists(collectionDir):
-		os.mkdir(collectionDir)
+	if hardLink:
+		try:
+			os.link(sourcePath, destinationPath)
+			return
+		except OSError:
+			pass
+	shutil.copyfile(sourcePath, destinationPath)
+
+def publishFile(sourcePath, destinationPath):
+	"""Puts the copy of the file in the library. The file appears under its name at once, even if it replaces the older version."""
+	tempPath = destinationPath + '.tmp'
+	linkOrCopy(sourcePath, tempPath)
+	compression.removeVariant(destinationPath)
+	os.replace(tempPath, destinationPath)
+	publishVariant(destinationPath)
+
+def publishVariant(path):
+	"""Writes the compressed variant of the published file, if it's enabled and saves enough bytes."""
+	if compressionMinSaving is None:
+		return
+	with stats.timer('compression'):
+		stats.count('bytes_saved', compression.writeVariant(path, compressionMinSaving))
 
-	# 'newName' is the name of the .mobi file
-	for (name, newName, data, conversion) in attachments:
-		if not conversion:
-			print('* ' + name)
-			with open(os.path.join(collectionDir, name), 'wb') as f:
-				f.write(data)
+class ConversionCache:
+	"""Persistent cache of converted files. The key is the hash of the input file content and the converter
+	command line, so the same book sent again (even to other collection) is not converted the second time.
+	The least recently used files are removed when the cache exceeds maxSize bytes.
+	"""
 
-			filesChanged.append(name)
-		else:
-			print('* ' + name + " > " + newName + "  || Conversion ...", end = "")  # no newline
-			tempFilePath = os.path.join(temporaryDir, withColl(name))
-			with open(tempFilePath, 'wb') as f:
-				f.write(data)
-
-			# perform conversion
-			if not disableConversion:
-				changeNewName = eval(config['mobi_converter']['output_file'])
-				command = re.sub(r'@@OLD_NAME@@', tempFilePath, config['mobi_converter']['command'])
-				command = re.sub(r'@@NEW_NAME@@', changeNewName(os.path.join(tempFilePath, withColl(newName))), command)
-
-				with open("/dev/null", "w") as devNull:
-					ret = subprocess.call(command.split(), stdout = devNull)
-
-				valuesSuccess = [int(val.strip()) for val in config['mobi_converter']['values_success'].split(';')]
-				if ret in valuesSuccess:
-					print("OK.")
-					shutil.move(os.path.join(temporaryDir, withColl(newName)), os.path.join(collectionDir, newName))
-					filesChanged.append(newName)
+	def __init__(self, directory, maxSize):
+		self.directory = directory
+		self.maxSize = maxSize
+		self.hits = 0
+		self.misses = 0
+		self.evicted = 0
+		self.lock = threading.Lock()
+		os.makedirs(directory, exist_ok = True)
+
+	def makeKey(self, sourcePath, converterId):
+		h = hashlib.sha256(converterId.encode('utf-8'))
+		h.update(b'\0')
+		with open(sourcePath, 'rb') as f:
+			for chunk in iter(lambda: f.read(1024 * 1024), b''):
+				h.update(chunk)
+		return h.hexdigest()
+
+	def fetch(self, key, destinationPath):
+		"""Puts the cached file under destinationPath. Returns False if it's not in the cache."""
+		cachedPath = os.path.join(self.directory, key + '.mobi')
+		try:
+			# modification time serves as the last use time
+			os.utime(cachedPath)
+			# the published file mustn't share the inode with the cache, the eviction wouldn't free any space
+			linkOrCopy(cachedPath, destinationPath, hardLink = False)
+		except FileNotFoundError:
+			with self.lock:
+				self.misses += 1
+			return False
+
+		with self.lock:
+			self.hits += 1
+		return True
+
+	def store(self, key, sourcePath):
+		cachedPath = os.path.join(self.directory, key + '.mobi')
+		tempPath = cachedPath + '.' + str(threading.get_ident()) + '.tmp'
+		linkOrCopy(sourcePath, tempPath, hardLink = False)
+		os.replace(tempPath, cachedPath)
+		self.evict()
+
+	def evict(self):
+		with self.lock:
+			entries = []
+			for name in os.listdir(self.directory):
+				if not name.endswith('.mobi'):
+					continue
+				try:
+					st = os.stat(os.path.join(self.directory, name))
+				except FileNotFoundError:
+					continue
+				entries.append((st.st_mtime, st.st_size, name))
+
+			totalSize = sum(size for mtime, size, name in entries)
+			for mtime, size, name in sorted(entries):
+				if totalSize <= self.maxSize:
+					break
+				os.remove(os.path.join(self.directory, name))
+				totalSize -= size
+				self.evicted += 1
+
+	def summary(self):
+		return "Conversion cache: %d hits, %d misses, %d evicted." % (self.hits, self.misses, self.evicted)
+
+def convertCached(sourcePath, destinationPath):
+	"""Takes the converted file from the cache or runs the converter and stores its result in the cache.
+	Returns the tuple (success, cached).
+	"""
+	if conversionCache is None:
+		return (convertFile(sourcePath, destinationPath), False)
+
+	key = conversionCache.makeKey(sourcePath, converter.identity() + '\0' + config['mobi_converter'].get('output_file', ''))
+	if conversionCache.fetch(key, destinationPath):
+		stats.count('cache_hits')
+		return (True, True)
+	stats.count('cache_misses')
+
+	success = convertFile(sourcePath, destinationPath)
+	if success:
+		conversionCache.store(key, destinationPath)
+	return (success, False)
+
+def convertAttachments(collWithAttachments):
+	"""Takes the list of tuples (collection name, attachments), converts the attachments from all collections
+	at the same time and puts them in the collection directories. Returns the list of tuples (collection name, changed files).
+	The converted files are created next to the spool files of the attachments.
+	"""
+	filesChanged = [(collectionName, []) for collectionName, attachments in collWithAttachments]
+
+	noJobs = config.getint('mobi_converter', 'jobs', fallback = os.cpu_count() or 1)
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers = max(1, noJobs)) as pool:
+		conversions = {}
+		for index, (collectionName, attachments) in enumerate(collWithAttachments):
+			collectionDir = os.path.join(config['DEFAULT']['output_directory'], convertToFileName(collectionName))
+
+			# create collection directory if needed
+			if not os.path.exists(collectionDir):
+				os.mkdir(collectionDir)
+
+			# 'newName' is the name of the .mobi file
+			for (name, newName, spoolPath, conversion) in attachments:
+				if not conversion:
+					print('* ' + name)
+					publishFile(spoolPath, os.path.join(collectionDir, name))
+					stats.count('bytes_out', os.path.getsize(spoolPath))
+					filesChanged[index][1].append(name)
 				else:
-					print("failed.")
+					if disableConversion:
+						print('* ' + name + " > " + newName + "  || Conversion disabled.")
+						continue
+
+					# next to the spool file and named after it, so it's unique too
+					tempNewPath = os.path.splitext(spoolPath)[0] + os.path.splitext(newName)[1]
+					future = pool.submit(convertCached, spoolPath, tempNewPath)
+					conversions[future] = (index, name, newName, tempNewPath, os.path.join(collectionDir, newName))
+
+		# results are printed in order of completion
+		for future in concurrent.futures.as_completed(conversions):
+			index, name, newName, tempNewPath, finalPath = conversions[future]
+			try:
+				success, cached = future.result()
+			except OSError as exp:
+				print("Could not run the converter: " + str(exp))
+				success = False
+
+			if success:
+				print('* ' + name + " > " + newName + "  || Conversion OK" + (" (cached)." if cached else "."))
+				compression.removeVariant(finalPath)
+				shutil.move(tempNewPath, finalPath)
+				publishVariant(finalPath)
+				stats.count('bytes_out', os.path.getsize(finalPath))
+				filesChanged[index][1].append(newName)
+			else:
+				print('* ' + name + " > " + newName + "  || Conversion failed.")
+
+	if conversionCache is not None and len(conversions) > 0:
+		print(conversionCache.summary())
 
-			# remove original file
-			os.remove(tempFilePath)
-
-	shutil.rmtree(temporaryDir)
 	return filesChanged
 
-def updateFilelist(collectionName, filesList, updateRebootFlag = False):
-	# TODO TODO TODO tylko to zostało
-	# update the changes list
+def updateFilelist(changes, updateRebootFlag = False):
+	"""Takes the list of tuples (collection name, changed files) and applies all of them to the FILELIST in one transaction."""
 	global config
-	if collectionName == "":
-	     collectionName = "___NO_COLLECTION___"
 
-	changes = configparser.SafeConfigParser()
-	changes.read(os.path.join(config['DEFAULT']['output_directory'], metadataFileName))
+	timestamp = time.strftime("%Y-%m-%d_%H:%M:%S", time.localtime())
 
-	if not changes.has_section(collectionName):
-		changes.add_section(collectionName)
+	# size and hash of the published files are computed before taking the lock
+	outputDirectory = config['DEFAULT']['output_directory']
+	with stats.timer('content_hash'):
+		contents = [[filelist.describeFile(os.path.join(outputDirectory, convertToFileName(collectionName), f)) for f in filesList]
+			for collectionName, filesList in changes]
 
-	timestamp = time.strftime("%Y-%m-%d_%H:%M:%S", time.localtime())
+	with stats.timer('filelist_write'), filelist.transaction(os.path.join(outputDirectory, metadataFileName)) as tr:
+		for (collectionName, filesList), fileContents in zip(changes, contents):
+			if collectionName == "":
+				collectionName = filelist.NO_COLLECTION
 
-	for f in filesList:
-		changes.set(collectionName, f, timestamp)
+			for f, content in zip(filesList, fileContents):
+				tr.set(collectionName, f, timestamp, content)
+			stats.count('files_published', len(filesList))
 
-	if updateRebootFlag:
-		changes['___SPECIAL___'] = {}
-		changes['___SPECIAL___']['RestartTimeStamp'] = timestamp;
+		if updateRebootFlag:
+			tr.setRestart(timestamp)
 
-	with open(os.path.join(config['DEFAULT']['output_directory'], metadataFileName), 'w') as configfile:
-	    changes.write(configfile)
+class MailboxWatcher:
+	"""Watches the directory using Linux inotify. The events are only counted, not interpreted, because
+	the whole Maildir is scanned anyway. Events coming during the processing are queued by the kernel.
+	"""
+	IN_CLOSE_WRITE = 0x008
+	IN_MOVED_TO = 0x080
+
+	def __init__(self, directory):
+		libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+		self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+		wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), self.IN_CLOSE_WRITE | self.IN_MOVED_TO)
+		if wd < 0:
+			os.close(self.fd)
+			raise OSError(ctypes.get_errno(), "inotify_add_watch failed for " + directory)
+
+	def wait(self, timeout = None):
+		"""Blocks until some events arrive or the timeout expires. Returns True if there were any events."""
+		readable, _, _ = select.select([self.fd], [], [], timeout)
+		if not readable:
+			return False
+		# drain the queue, IN_Q_OVERFLOW is fine too - the mailbox is rescanned anyway
+		try:
+			while os.read(self.fd, 4096):
+				pass
+		except BlockingIOError:
+			pass
+		return True
+
+class MailboxPoller:
+	"""Fallback for the systems without inotify. Checks the modification time of the directory periodically."""
+
+	def __init__(self, directory, interval):
+		self.directory = directory
+		self.interval = interval
+		self.lastMtime = os.stat(directory).st_mtime_ns
+
+	def wait(self, timeout = None):
+		deadline = None if timeout is None else time.monotonic() + timeout
+		while True:
+			mtime = os.stat(self.directory).st_mtime_ns
+			if mtime != self.lastMtime:
+				self.lastMtime = mtime
+				return True
+			if deadline is not None and time.monotonic() >= deadline:
+				return False
+			time.sleep(self.interval if deadline is None else max(0, min(self.interval, deadline - time.monotonic())))
+
+def mailboxBursts(watcher, debounce, maxDelay, nextWakeup = lambda: None):
+	"""Generator which yields once at start and then once per burst of deliveries. The burst ends when there
+	were no events for 'debounce' seconds or after 'maxDelay' seconds since its first event.
+	It also yields after nextWakeup() seconds without any deliveries, if it's not None."""
+	yield
+	while True:
+		if not watcher.wait(nextWakeup()):
+			yield
+			continue
+		deadline = time.monotonic() + maxDelay
+		while True:
+			remaining = deadline - time.monotonic()
+			if remaining <= 0 or not watcher.wait(min(debounce, remaining)):
+				break
+		yield
 
-def handler(signum, frame):
-	"""The handler is called after each change in the mailbox directory. Checks the
+def processJobs():
+	"""Converts and publishes the jobs waiting in the queue. The message is removed from the mailbox
+	when all its jobs are published.
+	"""
+	global jobQueue
+
+	jobs = jobQueue.takeReady()
+	if len(jobs) > 0:
+		# each job is a separate entry, so the result tells which job succeeded
+		results = convertAttachments([(job['collection'], [(job['name'], job['newName'], job['spoolPath'], bool(job['conversion']))]) for job in jobs])
+
+		published = []
+		for job, (collectionName, changeList) in zip(jobs, results):
+			if len(changeList) > 0:
+				published.append(job)
+			elif jobQueue.markFailed(job['id']):
+				print("Conversion of " + job['name'] + " will be retried.")
+			else:
+				print("Giving up on " + job['name'] + ". The message stays in the mailbox.")
+
+		if len(published) > 0:
+			rebootFlag = any(job['rebootFlag'] for job in published)
+			updateFilelist([(job['collection'], [job['newName'] if job['conversion'] else job['name']]) for job in published], rebootFlag)
+			if rebootFlag:
+				print("Updating reboot flag.")
+			jobQueue.markPublished([job['id'] for job in published])
+
+	finished = jobQueue.finishedMessages()
+	if len(finished) > 0:
+		mb = mailbox.Maildir(config['DEFAULT']['mailbox_path'])
+		for key in finished:
+			if not disableMailboxClearing:
+				mb.discard(key)
+			shutil.rmtree(os.path.join(spoolRoot, key), ignore_errors = True)
+			jobQueue.forgetMessage(key)
+		mb.close()
+
+	stats.setGauge('queue_depth', jobQueue.pendingCount())
+
+def exportMetrics():
+	"""Writes the metrics file if it's enabled and the export interval has passed."""
+	global lastMetricsExport
+
+	if not metricsFile or time.monotonic() - lastMetricsExport < metricsInterval:
+		return
+	lastMetricsExport = time.monotonic()
+
+	stats.setGauge('queue_depth', jobQueue.pendingCount())
+	stats.export(metricsFile, config.get('metrics', 'format', fallback = 'prometheus'))
+
+def nextWakeup():
+	"""Returns the number of seconds until the nearest retry or metrics export."""
+	delays = [jobQueue.nextRetryDelay()]
+	if metricsFile:
+		delays.append(max(0, lastMetricsExport + metricsInterval - time.monotonic()))
+	delays = [delay for delay in delays if delay is not None]
+	return min(delays) if len(delays) > 0 else None
+
+def processMailbox():
+	"""Called after each burst of changes in the mailbox directory. Checks the mailbox in passes limited
+	to 'batch_limit' messages until there's nothing left. The jobs are processed after each pass.
 	"""
 	global config
 	global validSenders
 
-	noFiles, rebootFlag, collWithAttachments = checkAndGetAttachments(config['DEFAULT']['mailbox_path'], validSenders)
-	if noFiles == 0:
-		print("No new files.")
-		return
-	print(str(noFiles) + " new files.")
+	batchLimit = config.getint('daemon', 'batch_limit', fallback = 0)
+	# in megabytes
+	maxSize = int(config.getfloat('DEFAULT', 'max_attachment_size', fallback = 0) * 1024 * 1024)
+	rejectedIndexPath = config.get('DEFAULT', 'rejected_index', fallback = os.path.join(config['DEFAULT']['mailbox_path'], '.mailbook-rejected'))
+
+	moreLeft = True
+	while moreLeft:
+		noFiles, rebootFlag, collWithAttachments, moreLeft = checkAndGetAttachments(config['DEFAULT']['mailbox_path'],
+				spoolRoot, validSenders, batchLimit, maxSize, rejectedIndexPath, jobQueue)
+		# without clearing the same messages would be found over and over
+		moreLeft = moreLeft and not disableMailboxClearing
+		if noFiles == 0:
+			print("No new files.")
+		else:
+			print(str(noFiles) + " new files.")
+
+		processJobs()
 
-	for collectionName, attachments in collWithAttachments:
-		changeList = convertAttachments(convertToFileName(collectionName), attachments)
-		if len(changeList) > 0:
-			updateFilelist(collectionName, changeList, rebootFlag)
+def setup(configuration):
+	"""Initializes the module state from the configuration: converter, cache, spool, job queue and metrics.
+	Used by the daemon and by the benchmark, so both run the same code.
+	"""
+	global config, stats, metricsFile, metricsInterval, lastMetricsExport, validSenders, converter
+	global compressionMinSaving, conversionCache, spoolRoot, jobQueue
 
-	if rebootFlag:
-		print("Updating reboot flag.")
+	config = configuration
+	stats = metrics.Metrics()
 
-	fcntl.fcntl(fd, fcntl.F_NOTIFY, fcntl.DN_ACCESS | fcntl.DN_MODIFY | fcntl.DN_CREATE)
+	metricsFile = config.get('metrics', 'file', fallback = '')
+	if metricsFile:
+		metricsFile = os.path.join(config['DEFAULT']['output_directory'], metricsFile)
+	metricsInterval = config.getfloat('metrics', 'interval', fallback = 60)
+	lastMetricsExport = -metricsInterval
 
-# MAIN CODE
-print("Mailbook " + __version__ + " " + __author__ + " - mailbox daemon script.")
+	validSenders = None
+	if config['DEFAULT']['check_senders']:
+		 validSenders = [s.strip() for s in config['DEFAULT']['valid_senders'].split(';')]
 
-# read configuration file
-config = getConfiguration(sys.argv[1] if len(sys.argv) > 1 else None)
+	converter = converters.create(config['mobi_converter'])
 
-validSenders = None
-if config['DEFAULT']['check_senders']:
-	 validSenders = [s.strip() for s in config['DEFAULT']['valid_senders'].split(';')]
+	compressionMinSaving = None
+	if config.getboolean('compression', 'gzip', fallback = True):
+		compressionMinSaving = config.getfloat('compression', 'min_saving', fallback = 0.1)
 
-fd = os.open(os.path.join(config['DEFAULT']['mailbox_path'], 'new'), os.O_RDONLY)
+	conversionCache = None
+	if config.get('cache', 'directory', fallback = ''):
+		conversionCache = ConversionCache(config['cache']['directory'], int(config.getfloat('cache', 'max_size', fallback = 500) * 1024 * 1024))
 
-if manualStart:
-	handler(None, None)
-else:
-	fcntl.fcntl(fd, fcntl.F_NOTIFY, fcntl.DN_ACCESS | fcntl.DN_MODIFY | fcntl.DN_CREATE)
-	signal.signal(signal.SIGIO, handler)
-	while True:
-		signal.pause()
+	stateDirectory = os.path.expanduser("~/.mailbook")
+	spoolRoot = config.get('DEFAULT', 'spool_directory', fallback = os.path.join(stateDirectory, 'spool'))
+	os.makedirs(spoolRoot, exist_ok = True)
 
+	queueFile = config.get('DEFAULT', 'queue_file', fallback = os.path.join(stateDirectory, 'queue.sqlite'))
+	os.makedirs(os.path.dirname(os.path.abspath(queueFile)), exist_ok = True)
+	jobQueue = jobqueue.JobQueue(queueFile, config.getfloat('daemon', 'retry_delay', fallback = 60), config.getint('daemon', 'max_attempts', fallback = 5))
+
+# MAIN CODE
+if __name__ == '__main__':
+	print("Mailbook " + __version__ + " " + __author__ + " - mailbox daemon script.")
+
+	# read configuration file
+	setup(getConfiguration(sys.argv[1] if len(sys.argv) > 1 else None))
+
+	if jobQueue.pendingCount() > 0:
+		print("Resuming " + str(jobQueue.pendingCount()) + " unfinished jobs.")
+
+	if manualStart:
+		processMailbox()
+		exportMetrics()
+	else:
+		newMailDirectory = os.path.join(config['DEFAULT']['mailbox_path'], 'new')
+		try:
+			watcher = MailboxWatcher(newMailDirectory)
+		except (OSError, AttributeError) as exp:
+			print("inotify not available (" + str(exp) + "), polling the mailbox instead.")
+			watcher = MailboxPoller(newMailDirectory, config.getfloat('daemon', 'poll_interval', fallback = 2.0))
+
+		for _ in mailboxBursts(watcher, config.getfloat('daemon', 'debounce', fallback = 0.5), config.getfloat('daemon', 'max_delay', fallback = 5.0),
+				nextWakeup):
+			processMailbox()
+			exportMetrics()
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+Storage of the FILELIST metadata file, shared by extract.py and kindle.py.
+
+Each transaction gets the next sequence number and its records are appended under the lock to the journal file,
+ended by the commit record with the sequence number, and to the change log next to FILELIST. The INI file is rewritten
+on every commit, because the older Kindle scripts read only it. FILELIST.jsonl and the .gz variants of both files
+are rewritten (compacted) only when the journal grows above compactRatio of the INI file. Then the journal is removed.
+The transactions in the journal newer than the sequence number of FILELIST.jsonl are replayed on load.
+The torn transaction left by a crash is cut off the journal before the next one is appended.
+
+libupdate.py fetches only the part of the change log it hasn't seen yet, after the full FILELIST it catches up
+from the log too. The log keeps the last historyLength transactions, older clients fall back to the full FILELIST.
+The transactions newer than FILELIST.jsonl are never cut off the log, so the full file and the log together always
+give the current metadata.
+
+The same metadata is written in the compact format to FILELIST.jsonl, which is faster to parse on Kindle: the header
+{"sequence": ..., "restart": ...} and [collection, file, timestamp, size, sha1, variant] line for each file, sorted
+by collection and file name. Timestamps are in seconds since epoch. The size and SHA1 of the content let Kindle skip
+the files it already has, variant tells whether the compressed variant of the file was published, so Kindle asks
+for '<file>.gz' only when it exists. They are kept only there, the INI file holds the bare timestamps the older Kindle
+scripts parse, so FILELIST.jsonl is read in preference to it. In memory the entry is 'timestamp size sha1 variant'.
+
+(C) 2013 Michał Słomkowski
+https://github.com/slomkowski/mailbook
+
+"""
+
+import calendar
+import configparser
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import re
+import time
+
+import compression
+
+SPECIAL_SECTION = '___SPECIAL___'
+NO_COLLECTION = '___NO_COLLECTION___'
+
+journalSuffix = '.journal'
+lockSuffix = '.lock'
+changesSuffix = '.changes'
+compactSuffix = '.jsonl'
+
+historyLength = 100
+# the full files are rewritten when the journal gets larger than this part of the INI file
+compactRatio = 0.1
+
+class Transaction:
+	"""Set of changes applied to the FILELIST at once. The metadata can be read as ConfigParser object."""
+
+	def __init__(self, metadata):
+		self.metadata = metadata
+		self.records = []
+
+	def sections(self):
+		return self.metadata.sections()
+
+	def set(self, collection, fileName, timestamp, content = None):
+		"""content is the tuple (size, sha1, variant) returned by describeFile."""
+		record = {'collection' : collection, 'file' : fileName, 'timestamp' : timestamp}
+		if content is not None:
+			record['size'], record['sha1'], record['variant'] = content
+		self.apply(record)
+
+	def setRestart(self, timestamp):
+		self.apply({'restart' : timestamp})
+
+	def apply(self, record):
+		applyRecord(self.metadata, record)
+		self.records.append(record)
+
+def matchCollection(sections, collection, exact = False):
+	"""Returns the shortest existing collection name matched by the given name at the beginning, ignoring the case.
+	The given name is returned if nothing matches or exact is set.
+	"""
+	if not exact:
+		matches = [name for name in sections if re.match(collection, name, re.I)]
+		if len(matches) > 0:
+			return min(matches, key = len)
+	return collection
+
+def describeFile(path):
+	"""Returns the tuple (size, sha1, variant) of the file content, variant is True if the compressed variant is next to it."""
+	h = hashlib.sha1()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(1024 * 1024), b''):
+			h.update(chunk)
+	return (os.path.getsize(path), h.hexdigest(), os.path.exists(compression.variantPath(path)))
+
+def formatEntry(record):
+	if 'sha1' in record:
+		return "%s %d %s %d" % (record['timestamp'], record['size'], record['sha1'], record.get('variant', False))
+	return record['timestamp']
+
+def toEpoch(timestamp):
+	return calendar.timegm(time.strptime(timestamp.split()[0], "%Y-%m-%d_%H:%M:%S"))
+
+def fromEpoch(seconds):
+	return time.strftime("%Y-%m-%d_%H:%M:%S", time.gmtime(seconds))
+
+def writeIni(metadata, f):
+	"""Writes the metadata as the INI file with the bare timestamps."""
+	ini = newParser()
+	for section in metadata.sections():
+		ini.add_section(section)
+		for fileName, value in metadata.items(section):
+			ini.set(section, fileName, value if section == SPECIAL_SECTION else value.split()[0])
+	ini.write(f)
+
+def readCompact(metadata, f):
+	"""Reads the metadata in the compact format."""
+	header = json.loads(f.readline())
+	setSequence(metadata, header.get('sequence') or 0)
+	if header.get('restart') is not None:
+		applyRecord(metadata, {'restart' : fromEpoch(header['restart'])})
+	for line in f:
+		# the files written by the older versions have no variant field
+		collection, fileName, timestamp, size, sha1, variant = (json.loads(line) + [False])[:6]
+		record = {'collection' : collection, 'file' : fileName, 'timestamp' : fromEpoch(timestamp)}
+		if sha1 is not None:
+			record['size'], record['sha1'], record['variant'] = size, sha1, bool(variant)
+		applyRecord(metadata, record)
+
+def writeCompact(metadata, f):
+	"""Writes the metadata in the compact format."""
+	restart = metadata.get(SPECIAL_SECTION, 'RestartTimeStamp', fallback = None)
+	f.write(json.dumps({'sequence' : int(metadata.get(SPECIAL_SECTION, 'Sequence', fallback = '0')),
+		'restart' : toEpoch(restart) if restart else None}) + "\n")
+
+	entries = []
+	for section in metadata.sections():
+		if section == SPECIAL_SECTION:
+			continue
+		for fileName, value in metadata.items(section):
+			fields = value.split()
+			size, sha1 = (int(fields[1]), fields[2]) if len(fields) >= 3 else (None, None)
+			variant = len(fields) >= 4 and fields[3] == '1'
+			entries.append([section, fileName, toEpoch(fields[0]), size, sha1, variant])
+	# collection and file name are unique, so the other fields are never compared
+	for entry in sorted(entries):
+		f.write(json.dumps(entry) + "\n")
+
+def applyRecord(metadata, record):
+	if 'restart' in record:
+		if not metadata.has_section(SPECIAL_SECTION):
+			metadata.add_section(SPECIAL_SECTION)
+		metadata.set(SPECIAL_SECTION, 'RestartTimeStamp', record['restart'])
+		return
+
+	if not metadata.has_section(record['collection']):
+		metadata.add_section(record['collection'])
+	metadata.set(record['collection'], record['file'], formatEntry(record))
+
+def readJournal(journalPath):
+	"""Returns the tuple (list of committed transactions (sequence, records), length of the journal up to the end
+	of the last one). The torn or unfinished transaction at the end is left out. sequence is None in the journals
+	written by the older versions.
+	"""
+	transactions = []
+	pending = []
+	length = 0
+	position = 0
+	try:
+		with open(journalPath, 'rb') as journal:
+			for line in journal:
+				position += len(line)
+				try:
+					if not line.endswith(b"\n"):
+						raise ValueError
+					record = json.loads(line.decode('utf-8'))
+				except ValueError:
+					# torn write, nothing after it was committed
+					break
+				if record.get('commit'):
+					transactions.append((record.get('sequence'), pending))
+					pending = []
+					length = position
+				else:
+					pending.append(record)
+	except FileNotFoundError:
+		pass
+	return (transactions, length)
+
+def getSequence(metadata):
+	return int(metadata.get(SPECIAL_SECTION, 'Sequence', fallback = '0'))
+
+def setSequence(metadata, sequence):
+	if not metadata.has_section(SPECIAL_SECTION):
+		metadata.add_section(SPECIAL_SECTION)
+	metadata.set(SPECIAL_SECTION, 'Sequence', str(sequence))
+
+def readChanges(changesPath):
+	"""Returns the lines of the change log and the last sequence number in it."""
+	try:
+		with open(changesPath, 'r', encoding = 'utf-8') as changes:
+			lines = [line for line in changes.readlines() if line.endswith("\n")]
+	except FileNotFoundError:
+		return ([], 0)
+	try:
+		return (lines, json.loads(lines[-1])['sequence'] if len(lines) > 0 else 0)
+	except (ValueError, KeyError):
+		return (lines, 0)
+
+def lineSequence(line):
+	try:
+		return json.loads(line)['sequence']
+	except (ValueError, KeyError):
+		return 0
+
+def appendChanges(path, transactions, snapshotSequence):
+	"""Appends the transactions [(sequence, records)] to the change log. The log is cut to the last historyLength
+	transactions when it grows twice as long, but the ones newer than snapshotSequence, the sequence number
+	of FILELIST.jsonl, are kept.
+	"""
+	changesPath = path + changesSuffix
+	lines, lastSequence = readChanges(changesPath)
+
+	newLines = [json.dumps({'sequence' : sequence, 'records' : records}) + "\n" for sequence, records in transactions]
+	allLines = lines + newLines
+	start = 0
+	if len(allLines) >= 2 * historyLength:
+		start = len(allLines) - historyLength
+		while start > 0 and lineSequence(allLines[start - 1]) > snapshotSequence:
+			start -= 1
+
+	if start > 0:
+		writeAtomically(changesPath, lambda f: f.writelines(allLines[start:]))
+	else:
+		with open(changesPath, 'a', encoding = 'utf-8') as changes:
+			changes.writelines(newLines)
+			changes.flush()
+			os.fsync(changes.fileno())
+
+def newParser():
+	return configparser.ConfigParser(interpolation = None)
+
+def replayJournal(metadata, transactions):
+	"""Applies the transactions newer than the metadata."""
+	sequence = getSequence(metadata)
+	for transactionSequence, records in transactions:
+		if transactionSequence is None or transactionSequence > sequence:
+			for record in records:
+				applyRecord(metadata, record)
+			if transactionSequence is not None:
+				sequence = transactionSequence
+	setSequence(metadata, sequence)
+
+def readSnapshot(path):
+	"""Reads the metadata from FILELIST.jsonl or from the INI file if there's none."""
+	metadata = newParser()
+	try:
+		with open(path + compactSuffix, 'r', encoding = 'utf-8') as f:
+			readCompact(metadata, f)
+	except FileNotFoundError:
+		metadata.read(path, encoding = 'utf-8')
+	return metadata
+
+def load(path):
+	"""Returns the current metadata as ConfigParser object, including the changes not yet compacted from the journal."""
+	metadata = readSnapshot(path)
+	replayJournal(metadata, readJournal(path + journalSuffix)[0])
+	return metadata
+
+def writeAtomically(path, writeFunction, binary = False):
+	"""Calls writeFunction with the temporary file object, then renames it to path."""
+	tempPath = path + '.tmp'
+	with (open(tempPath, 'wb') if binary else open(tempPath, 'w', encoding = 'utf-8')) as f:
+		writeFunction(f)
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(tempPath, path)
+
+def compact(path, metadata):
+	"""Rewrites the full files from the metadata and removes the journal."""
+	writeAtomically(path, lambda f: writeIni(metadata, f))
+	writeAtomically(path + compactSuffix, lambda f: writeCompact(metadata, f))
+	# the metadata always compresses well, the variants are kept in any case so they're never stale
+	compression.writeVariant(path)
+	compression.writeVariant(path + compactSuffix)
+	try:
+		os.remove(path + journalSuffix)
+	except FileNotFoundError:
+		pass
+
+@contextlib.contextmanager
+def transaction(path, forceCompaction = False):
+	"""Context manager which locks the FILELIST and returns Transaction object. The changes are committed
+	when the block exits without exception. With forceCompaction the full files are rewritten in any case.
+	"""
+	with open(path + lockSuffix, 'a') as lockFile:
+		fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX)
+		try:
+			journalPath = path + journalSuffix
+			metadata = readSnapshot(path)
+			snapshotSequence = getSequence(metadata)
+			transactions, journalLength = readJournal(journalPath)
+			replayJournal(metadata, transactions)
+
+			tr = Transaction(metadata)
+			yield tr
+
+			if len(tr.records) > 0:
+				lastLogged = readChanges(path + changesSuffix)[1]
+				# after the crash the log can be ahead of the journal and the journal ahead of the log
+				sequence = max(getSequence(metadata), lastLogged) + 1
+
+				with open(journalPath, 'ab') as journal:
+					journal.truncate(journalLength)
+					for record in tr.records + [{'commit' : True, 'sequence' : sequence}]:
+						journal.write((json.dumps(record) + "\n").encode('utf-8'))
+					journal.flush()
+					os.fsync(journal.fileno())
+				setSequence(metadata, sequence)
+
+				# the transactions which didn't get to the log before the crash
+				missing = [(transactionSequence, records) for transactionSequence, records in transactions
+					if transactionSequence is not None and transactionSequence > lastLogged]
+				appendChanges(path, missing + [(sequence, tr.records)], snapshotSequence)
+
+			if forceCompaction or (len(tr.records) > 0 and (not os.path.exists(path)
+					or not os.path.exists(path + compactSuffix)
+					or os.path.getsize(journalPath) > compactRatio * os.path.getsize(path))):
+				compact(path, metadata)
+			elif len(tr.records) > 0:
+				writeAtomically(path, lambda f: writeIni(metadata, f))
+				# the variant would be older than the INI file, it's written again by the next compaction
+				compression.removeVariant(path)
+		finally:
+			fcntl.flock(lockFile.fileno(), fcntl.LOCK_UN)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Durable queue of conversion jobs for extract.py, stored in SQLite database.
+
+Each attachment of the accepted message becomes a job. The job goes through the states:
+extracted -> converting -> published, or to failed if the conversion didn't succeed. Failed jobs are retried
+with growing delay. The mail can be removed from the mailbox only when all its jobs are published.
+
+(C) 2013 Michał Słomkowski
+https://github.com/slomkowski/mailbook
+
+"""
+
+import sqlite3
+import time
+
+EXTRACTED = 'extracted'
+CONVERTING = 'converting'
+PUBLISHED = 'published'
+FAILED = 'failed'
+
+class JobQueue:
+
+	def __init__(self, path, retryDelay = 60, maxAttempts = 5):
+		self.retryDelay = retryDelay
+		self.maxAttempts = maxAttempts
+		self.db = sqlite3.connect(path)
+		self.db.row_factory = sqlite3.Row
+		with self.db:
+			self.db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+				id INTEGER PRIMARY KEY,
+				message TEXT NOT NULL,
+				collection TEXT NOT NULL,
+				name TEXT NOT NULL,
+				newName TEXT NOT NULL,
+				spoolPath TEXT NOT NULL,
+				conversion INTEGER NOT NULL,
+				rebootFlag INTEGER NOT NULL,
+				state TEXT NOT NULL,
+				attempts INTEGER NOT NULL DEFAULT 0,
+				nextAttempt REAL NOT NULL DEFAULT 0)""")
+			self.db.execute("CREATE INDEX IF NOT EXISTS jobsMessage ON jobs (message)")
+			# the conversions interrupted by the crash are started again
+			self.db.execute("UPDATE jobs SET state = ? WHERE state = ?", (EXTRACTED, CONVERTING))
+
+	def hasMessage(self, key):
+		return self.db.execute("SELECT 1 FROM jobs WHERE message = ? LIMIT 1", (key,)).fetchone() is not None
+
+	def addMessage(self, key, collection, rebootFlag, attachments):
+		"""Takes the list of tuples (fileName, newName, spoolPath, performConversion) and adds them as the jobs."""
+		with self.db:
+			self.db.executemany("""INSERT INTO jobs (message, collection, name, newName, spoolPath, conversion, rebootFlag, state)
+				VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+				[(key, collection, name, newName, spoolPath, int(conversion), int(rebootFlag), EXTRACTED)
+					for (name, newName, spoolPath, conversion) in attachments])
+
+	def takeReady(self, limit = None):
+		"""Returns the jobs waiting for conversion and the failed ones which are due to retry. Marks them as converting."""
+		with self.db:
+			jobs = self.db.execute("""SELECT * FROM jobs WHERE state = ? OR (state = ? AND attempts < ? AND nextAttempt <= ?)
+				ORDER BY id LIMIT ?""", (EXTRACTED, FAILED, self.maxAttempts, time.time(), limit or -1)).fetchall()
+			self.db.executemany("UPDATE jobs SET state = ? WHERE id = ?", [(CONVERTING, job['id']) for job in jobs])
+		return jobs
+
+	def markFailed(self, jobId):
+		"""Schedules the retry of the job. Returns False if the job has run out of attempts."""
+		with self.db:
+			attempts = self.db.execute("SELECT attempts FROM jobs WHERE id = ?", (jobId,)).fetchone()[0] + 1
+			nextAttempt = time.time() + self.retryDelay * 2 ** (attempts - 1)
+			self.db.execute("UPDATE jobs SET state = ?, attempts = ?, nextAttempt = ? WHERE id = ?", (FAILED, attempts, nextAttempt, jobId))
+		return attempts < self.maxAttempts
+
+	def markPublished(self, jobIds):
+		with self.db:
+			self.db.executemany("UPDATE jobs SET state = ? WHERE id = ?", [(PUBLISHED, jobId) for jobId in jobIds])
+
+	def finishedMessages(self):
+		"""Returns the keys of messages which have all jobs published."""
+		return [row[0] for row in self.db.execute("""SELECT message FROM jobs GROUP BY message
+			HAVING SUM(state != ?) = 0""", (PUBLISHED,))]
+
+	def forgetMessage(self, key):
+		with self.db:
+			self.db.execute("DELETE FROM jobs WHERE message = ?", (key,))
+
+	def pendingCount(self):
+		"""Returns the number of jobs which are not published and not given up."""
+		return self.db.execute("SELECT COUNT(*) FROM jobs WHERE state IN (?, ?) OR (state = ? AND attempts < ?)",
+			(EXTRACTED, CONVERTING, FAILED, self.maxAttempts)).fetchone()[0]
+
+	def nextRetryDelay(self):
+		"""Returns the number of seconds to the nearest retry or None if there's nothing to retry."""
+		nextAttempt = self.db.execute("SELECT MIN(nextAttempt) FROM jobs WHERE state = ? AND attempts < ?",
+			(FAILED, self.maxAttempts)).fetchone()[0]
+		if nextAttempt is None:
+			return None
+		return max(0, nextAttempt - time.time())
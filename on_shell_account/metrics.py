@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Counters, stage timers and histograms of extract.py. They are exported to the file in Prometheus text format
+(suitable for node_exporter textfile collector) or as JSON snapshot.
+
+(C) 2013 Michał Słomkowski
+https://github.com/slomkowski/mailbook
+
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+prefix = 'mailbook_'
+
+# upper bounds of histogram buckets in seconds
+defaultBuckets = (0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600)
+
+class Metrics:
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.counters = {}
+		self.gauges = {}
+		# name -> [number of calls, overall time]
+		self.stages = {}
+		# name -> (bucket bounds, counts per bucket, sum, count)
+		self.histograms = {}
+		self.startTime = time.time()
+
+	def count(self, name, value = 1):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + value
+
+	def setGauge(self, name, value):
+		with self.lock:
+			self.gauges[name] = value
+
+	@contextlib.contextmanager
+	def timer(self, stage):
+		"""Measures the time spent in the block and adds it to the stage."""
+		start = time.monotonic()
+		try:
+			yield
+		finally:
+			elapsed = time.monotonic() - start
+			with self.lock:
+				calls, overall = self.stages.get(stage, (0, 0.0))
+				self.stages[stage] = (calls + 1, overall + elapsed)
+
+	def observe(self, name, value, buckets = defaultBuckets):
+		with self.lock:
+			bounds, counts, total, number = self.histograms.get(name, (buckets, [0] * len(buckets), 0.0, 0))
+			for i, bound in enumerate(bounds):
+				if value <= bound:
+					counts[i] += 1
+			self.histograms[name] = (bounds, counts, total + value, number + 1)
+
+	def toJson(self):
+		with self.lock:
+			return json.dumps({
+				'timestamp' : int(time.time()),
+				'uptime' : time.time() - self.startTime,
+				'counters' : self.counters,
+				'gauges' : self.gauges,
+				'stages' : dict((name, {'count' : calls, 'seconds' : overall}) for name, (calls, overall) in self.stages.items()),
+				'histograms' : dict((name, {'buckets' : dict(zip((str(b) for b in bounds), counts)), 'sum' : total, 'count' : number})
+					for name, (bounds, counts, total, number) in self.histograms.items()),
+				}, sort_keys = True, indent = 1)
+
+	def toPrometheus(self):
+		lines = []
+		with self.lock:
+			for name, value in sorted(self.counters.items()):
+				lines.append("# TYPE %s%s_total counter" % (prefix, name))
+				lines.append("%s%s_total %s" % (prefix, name, value))
+			for name, value in sorted(self.gauges.items()):
+				lines.append("# TYPE %s%s gauge" % (prefix, name))
+				lines.append("%s%s %s" % (prefix, name, value))
+
+			# all samples of one metric have to be grouped together
+			if len(self.stages) > 0:
+				lines.append("# TYPE %sstage_seconds_total counter" % prefix)
+				for stage, (calls, overall) in sorted(self.stages.items()):
+					lines.append('%sstage_seconds_total{stage="%s"} %f' % (prefix, stage, overall))
+				lines.append("# TYPE %sstage_calls_total counter" % prefix)
+				for stage, (calls, overall) in sorted(self.stages.items()):
+					lines.append('%sstage_calls_total{stage="%s"} %d' % (prefix, stage, calls))
+
+			for name, (bounds, counts, total, number) in sorted(self.histograms.items()):
+				lines.append("# TYPE %s%s histogram" % (prefix, name))
+				for bound, bucketCount in zip(bounds, counts):
+					lines.append('%s%s_bucket{le="%s"} %d' % (prefix, name, bound, bucketCount))
+				lines.append('%s%s_bucket{le="+Inf"} %d' % (prefix, name, number))
+				lines.append("%s%s_sum %f" % (prefix, name, total))
+				lines.append("%s%s_count %d" % (prefix, name, number))
+
+			lines.append("# TYPE %suptime_seconds gauge" % prefix)
+			lines.append("%suptime_seconds %f" % (prefix, time.time() - self.startTime))
+		return "\n".join(lines) + "\n"
+
+	def export(self, path, format = 'prometheus'):
+		"""Writes the metrics to the file. The file is replaced at once, so the readers never see it half-written."""
+		content = self.toJson() if format == 'json' else self.toPrometheus()
+		tempPath = path + '.tmp'
+		with open(tempPath, 'w') as f:
+			f.write(content)
+		os.replace(tempPath, path)
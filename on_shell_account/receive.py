@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Receiving side of kindle.py on the shell account. kindle.py runs it over SSH and streams the books as tar archive
+to its stdin, so the whole update takes one SSH connection:
+
+ssh user@host python3 mailbook/on_shell_account/receive.py /home/user/public_html/kindle
+
+The first member of the archive is MANIFEST.json: {"collection": name or null, "exact": bool, "restart": bool}.
+The collection name is matched against FILELIST here, the same way as kindle.py does it. The books follow, each one
+optionally with its compressed variant. They are written to the collection directory as they arrive. When the archive
+ends, the variants left from the older versions are removed and FILELIST is updated in one transaction, under
+the lock shared with extract.py, so the concurrent updates are not lost.
+
+(C) 2013 Michał Słomkowski
+https://github.com/slomkowski/mailbook
+
+"""
+
+import json
+import os
+import shutil
+import sys
+import tarfile
+import time
+
+import compression
+import filelist
+from extract import convertToFileName
+
+manifestName = 'MANIFEST.json'
+metadataFileName = 'FILELIST'
+
+def receive(libraryPath, stream):
+	"""Reads the archive from the stream and publishes the books. Returns the tuple (collection, list of the books)."""
+	metadataPath = os.path.join(libraryPath, metadataFileName)
+	manifest = None
+	books = []
+	variants = set()
+
+	with tarfile.open(fileobj = stream, mode = 'r|') as archive:
+		for member in archive:
+			if manifest is None:
+				if member.name != manifestName:
+					raise ValueError("The archive doesn't start with " + manifestName)
+				manifest = json.loads(archive.extractfile(member).read().decode('utf-8'))
+
+				if manifest.get('collection'):
+					sections = filelist.load(metadataPath).sections()
+					collection = filelist.matchCollection(sections, manifest['collection'], manifest.get('exact', False))
+					print(("Using collection name: " if collection in sections else "Creating collection: ") + collection)
+					collectionDir = os.path.join(libraryPath, convertToFileName(collection))
+					os.makedirs(collectionDir, exist_ok = True)
+				else:
+					collection = filelist.NO_COLLECTION
+					collectionDir = libraryPath
+				continue
+
+			# only plain files straight in the collection directory
+			name = os.path.basename(member.name)
+			if not member.isfile() or name != member.name or name.startswith('.') or name.startswith(metadataFileName):
+				print("Omitting " + member.name)
+				continue
+
+			path = os.path.join(collectionDir, name)
+			with open(path + '.tmp', 'wb') as f:
+				shutil.copyfileobj(archive.extractfile(member), f, 1024 * 1024)
+			os.replace(path + '.tmp', path)
+
+			if name.endswith(compression.suffix):
+				variants.add(name[:-len(compression.suffix)])
+			else:
+				books.append(name)
+
+	if manifest is None:
+		raise ValueError("Empty archive.")
+
+	# Kindle mustn't download the old content from the variant of the previous version
+	for name in books:
+		if name not in variants:
+			compression.removeVariant(os.path.join(collectionDir, name))
+
+	timestamp = time.strftime("%Y-%m-%d_%H:%M:%S", time.gmtime())
+	contents = [filelist.describeFile(os.path.join(collectionDir, name)) for name in books]
+
+	with filelist.transaction(metadataPath) as tr:
+		if manifest.get('restart'):
+			print("Applying restart flag.")
+			tr.setRestart(timestamp)
+		for name, content in zip(books, contents):
+			tr.set(collection, name, timestamp, content)
+
+	return (collection, books)
+
+if __name__ == '__main__':
+	if len(sys.argv) != 2:
+		print("Usage: receive.py <library directory>", file = sys.stderr)
+		sys.exit(2)
+
+	try:
+		collection, books = receive(sys.argv[1], sys.stdin.buffer)
+	except (OSError, ValueError, tarfile.TarError) as exp:
+		print("Error. " + str(exp), file = sys.stderr)
+		sys.exit(1)
+
+	print("Received %d files." % len(books))
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the streaming MIME parser of extract.py. The attachments it writes to the spool are compared with
+the payloads decoded by the email package.
+
+$ python3 -m unittest discover on_shell_account
+
+"""
+
+import base64
+import email
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import extract
+
+def attachmentPart(fileName, encoding, body):
+	return (b"Content-Type: application/octet-stream\n"
+		b"Content-Disposition: attachment; filename=\"" + fileName + b"\"\n"
+		b"Content-Transfer-Encoding: " + encoding + b"\n\n" + body)
+
+def multipart(subtype, boundary, parts):
+	"""Returns the headers and the body of the multipart with the given parts (headers and body)."""
+	body = b"preamble\n"
+	for part in parts:
+		body += b"--" + boundary + b"\n" + part + b"\n"
+	body += b"--" + boundary + b"--\nepilogue\n"
+	return b"Content-Type: multipart/" + subtype + b"; boundary=\"" + boundary + b"\"\n\n" + body
+
+def message(body):
+	return b"From: reader@example.com\nSubject: kindle\nMIME-Version: 1.0\n" + body
+
+binaryContent = bytes(range(256)) * 20
+base64Body = base64.encodebytes(binaryContent)
+quotedBody = b"The first line with =3D sign\nSoft =\nline break and trailing spaces=20=20\n\nLast line"
+plainBody = b"Plain text book.\n\nWith the empty line\nand no line break at the end"
+
+mixedMessage = message(multipart(b"mixed", b"outer", [
+	multipart(b"alternative", b"inner", [
+		b"Content-Type: text/plain\n\nText of the message.",
+		b"Content-Type: text/html\n\n<p>Text of the message.</p>",
+		]),
+	attachmentPart(b"binary.pdf", b"base64", base64Body),
+	attachmentPart(b"quoted.txt", b"quoted-printable", quotedBody),
+	attachmentPart(b"plain.txt", b"7bit", plainBody),
+	]))
+
+class StreamingParserTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp('extract')
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def extract(self, raw, maxSize = 0):
+		"""Returns the dictionary file name -> content written by the streaming parser."""
+		lines = extract.readLines(io.BytesIO(raw))
+		headers = extract.readHeaders(lines)
+		result = {}
+		for fileName, newName, spoolPath, performConversion in extract.extractAttachments(lines, headers, self.directory, maxSize):
+			with open(spoolPath, 'rb') as f:
+				result[fileName] = f.read()
+		return result
+
+	def reference(self, raw):
+		"""Returns the dictionary file name -> content decoded by the email package."""
+		return dict((part.get_filename(), part.get_payload(decode = True)) for part in email.message_from_bytes(raw).walk()
+			if part.get_content_disposition() == 'attachment')
+
+	def testEncodings(self):
+		result = self.extract(mixedMessage)
+		self.assertEqual(sorted(result), ['binary.pdf', 'plain.txt', 'quoted.txt'])
+		self.assertEqual(result['binary.pdf'], binaryContent)
+		self.assertEqual(result, self.reference(mixedMessage))
+
+	def testCrlfLineEndings(self):
+		raw = mixedMessage.replace(b"\n", b"\r\n")
+		result = self.extract(raw)
+		self.assertEqual(result['binary.pdf'], binaryContent)
+		self.assertEqual(result, self.reference(raw))
+
+	def testNestedAlternativeWithAttachment(self):
+		raw = message(multipart(b"mixed", b"outer", [
+			multipart(b"alternative", b"inner", [
+				b"Content-Type: text/plain\n\n--outer is not the boundary here",
+				attachmentPart(b"inside.txt", b"7bit", b"--inner-not-a-boundary\ncontent"),
+				]),
+			attachmentPart(b"outside.txt", b"quoted-printable", quotedBody),
+			]))
+		result = self.extract(raw)
+		self.assertEqual(sorted(result), ['inside.txt', 'outside.txt'])
+		self.assertEqual(result, self.reference(raw))
+
+	def testSizeLimit(self):
+		reference = self.reference(mixedMessage)
+		maxSize = len(reference['binary.pdf']) - 1
+		result = self.extract(mixedMessage, maxSize)
+		self.assertEqual(result, dict((name, content) for name, content in reference.items() if len(content) <= maxSize))
+		self.assertNotIn('binary.pdf', result)
+		# the omitted attachment leaves no file in the spool
+		self.assertEqual(len(os.listdir(self.directory)), len(result))
+
+	def testSameNamedAttachments(self):
+		raw = message(multipart(b"mixed", b"outer", [
+			attachmentPart(b"book.txt", b"7bit", b"first"),
+			attachmentPart(b"book.txt", b"7bit", b"second"),
+			]))
+		lines = extract.readLines(io.BytesIO(raw))
+		attachments = extract.extractAttachments(lines, extract.readHeaders(lines), self.directory)
+		contents = []
+		for fileName, newName, spoolPath, performConversion in attachments:
+			with open(spoolPath, 'rb') as f:
+				contents.append(f.read())
+		self.assertEqual(contents, [b"first", b"second"])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the FILELIST store: journal replay, compaction and crash recovery.
+
+$ python3 -m unittest discover on_shell_account
+
+"""
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import compression
+import filelist
+
+class FilelistTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp('filelist')
+		self.path = os.path.join(self.directory, 'FILELIST')
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def commit(self, collection, names, timestamp = '2013-01-08_00:00:00'):
+		with filelist.transaction(self.path) as tr:
+			for name in names:
+				tr.set(collection, name, timestamp)
+
+	def loggedSequences(self):
+		with open(self.path + filelist.changesSuffix) as f:
+			return [json.loads(line)['sequence'] for line in f]
+
+	def testCommitAppendsToJournal(self):
+		self.commit('Books', ['book_%d.mobi' % i for i in range(200)])
+		self.assertFalse(os.path.exists(self.path + filelist.journalSuffix))
+		with open(self.path + filelist.compactSuffix) as f:
+			before = f.read()
+
+		self.commit('Books', ['new.mobi'])
+		with open(self.path + filelist.compactSuffix) as f:
+			self.assertEqual(before, f.read())
+		self.assertTrue(os.path.exists(self.path + filelist.journalSuffix))
+
+		metadata = filelist.load(self.path)
+		self.assertTrue(metadata.has_option('Books', 'new.mobi'))
+		self.assertEqual(filelist.getSequence(metadata), 2)
+		self.assertEqual(self.loggedSequences(), [1, 2])
+
+	def testJournalIsCompacted(self):
+		self.commit('Books', ['book_%d.mobi' % i for i in range(50)])
+		for i in range(20):
+			self.commit('News', ['news_%d.mobi' % i])
+
+		# the full file is rewritten from time to time and it's never more than the journal behind
+		self.assertLess(os.path.getsize(self.path + filelist.journalSuffix) if os.path.exists(self.path + filelist.journalSuffix) else 0,
+			filelist.compactRatio * os.path.getsize(self.path) + 200)
+		metadata = filelist.load(self.path)
+		self.assertEqual(len(metadata.options('News')), 20)
+		self.assertEqual(filelist.getSequence(metadata), 21)
+
+		with filelist.transaction(self.path, forceCompaction = True):
+			pass
+		self.assertFalse(os.path.exists(self.path + filelist.journalSuffix))
+		compacted = filelist.newParser()
+		compacted.read(self.path)
+		self.assertEqual(len(compacted.options('News')), 20)
+
+	def testIniDoesNotLag(self):
+		self.commit('Books', ['book_%d.mobi' % i for i in range(200)])
+		for i in range(30):
+			self.commit('News', ['news_%d.mobi' % i], '2013-01-09_00:00:%02d' % i)
+
+			# the older Kindle scripts read only the INI file, it has every committed book at once
+			ini = filelist.newParser()
+			ini.read(self.path)
+			metadata = filelist.load(self.path)
+			for section in metadata.sections():
+				self.assertEqual(dict((name, value.split()[0]) for name, value in metadata.items(section)), dict(ini.items(section)))
+			self.assertEqual(ini.get(filelist.SPECIAL_SECTION, 'Sequence'), str(i + 2))
+			if os.path.exists(compression.variantPath(self.path)):
+				with gzip.open(compression.variantPath(self.path)) as variant, open(self.path, 'rb') as f:
+					self.assertEqual(variant.read(), f.read())
+
+	def testLogCoversSnapshot(self):
+		# there are more transactions between the compactions than the log keeps
+		self.addCleanup(setattr, filelist, 'historyLength', filelist.historyLength)
+		filelist.historyLength = 10
+		self.commit('Books', ['book_%d.mobi' % i for i in range(1000)])
+		for i in range(100):
+			self.commit('News', ['news_%d.mobi' % i])
+
+			# the full file and the change log give the current metadata together
+			with open(self.path + filelist.compactSuffix) as f:
+				snapshotSequence = json.loads(f.readline())['sequence']
+			sequences = self.loggedSequences()
+			self.assertLessEqual(sequences[0], snapshotSequence + 1)
+			self.assertEqual(sequences, list(range(sequences[0], i + 3)))
+		self.assertLess(len(self.loggedSequences()), 100)
+
+	def testTornTailIsCutOff(self):
+		self.commit('Books', ['book_%d.mobi' % i for i in range(200)])
+		self.commit('Books', ['first.mobi'])
+		# crash in the middle of writing the next transaction
+		with open(self.path + filelist.journalSuffix, 'a') as journal:
+			journal.write('{"collection": "Books", "file": "torn.mobi", "timest')
+
+		self.commit('Books', ['second.mobi'])
+		metadata = filelist.load(self.path)
+		self.assertTrue(metadata.has_option('Books', 'first.mobi'))
+		self.assertTrue(metadata.has_option('Books', 'second.mobi'))
+		self.assertFalse(metadata.has_option('Books', 'torn.mobi'))
+
+	def testUncommittedTransactionIsIgnored(self):
+		self.commit('Books', ['book_%d.mobi' % i for i in range(200)])
+		with open(self.path + filelist.journalSuffix, 'a') as journal:
+			journal.write(json.dumps({'collection' : 'Books', 'file' : 'lost.mobi', 'timestamp' : '2013-01-08_00:00:00'}) + "\n")
+
+		self.assertFalse(filelist.load(self.path).has_option('Books', 'lost.mobi'))
+		self.commit('Books', ['next.mobi'])
+		metadata = filelist.load(self.path)
+		self.assertFalse(metadata.has_option('Books', 'lost.mobi'))
+		self.assertTrue(metadata.has_option('Books', 'next.mobi'))
+
+	def testMissingLogEntryIsRecovered(self):
+		self.commit('Books', ['book_%d.mobi' % i for i in range(200)])
+		self.commit('Books', ['first.mobi'])
+		# crash after the journal was written, before the change log
+		changesPath = self.path + filelist.changesSuffix
+		with open(changesPath) as f:
+			lines = f.readlines()
+		with open(changesPath, 'w') as f:
+			f.writelines(lines[:-1])
+
+		self.commit('Books', ['second.mobi'])
+		self.assertEqual(self.loggedSequences(), [1, 2, 3])
+
+	def testOlderJournalIsNotReplayed(self):
+		self.commit('Books', ['book_%d.mobi' % i for i in range(200)])
+		self.commit('Books', ['book_0.mobi'], '2013-01-09_00:00:00')
+
+		# the full files sent by kindle.py are newer than the journal on the server
+		metadata = filelist.load(self.path)
+		metadata.set('Books', 'book_0.mobi', '2013-01-10_00:00:00')
+		filelist.setSequence(metadata, 3)
+		filelist.writeAtomically(self.path, lambda f: filelist.writeIni(metadata, f))
+		filelist.writeAtomically(self.path + filelist.compactSuffix, lambda f: filelist.writeCompact(metadata, f))
+
+		self.assertEqual(filelist.load(self.path).get('Books', 'book_0.mobi'), '2013-01-10_00:00:00')
+
+	def testIniHoldsBareTimestamps(self):
+		with filelist.transaction(self.path, forceCompaction = True) as tr:
+			tr.set('Books', 'book.mobi', '2013-01-08_12:30:00', (1234, 'a' * 40, True))
+			tr.setRestart('2013-01-08_12:30:00')
+
+		# the older Kindle scripts parse the value with strptime
+		ini = filelist.newParser()
+		ini.read(self.path)
+		self.assertEqual(ini.get('Books', 'book.mobi'), '2013-01-08_12:30:00')
+
+		self.assertEqual(filelist.load(self.path).get('Books', 'book.mobi'), '2013-01-08_12:30:00 1234 ' + 'a' * 40 + ' 1')
+		os.remove(self.path + filelist.compactSuffix)
+		self.assertEqual(filelist.load(self.path).get('Books', 'book.mobi'), '2013-01-08_12:30:00')
+
+if __name__ == '__main__':
+	unittest.main()